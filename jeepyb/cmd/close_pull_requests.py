@@ -39,10 +39,14 @@
 # oauth_token = GITHUB_OAUTH_TOKEN
 
 import argparse
+import calendar
 import ConfigParser
 import github
 import logging
+from multiprocessing import pool
 import os
+import threading
+import time
 
 import jeepyb.log as l
 import jeepyb.projects as p
@@ -61,15 +65,102 @@ http://docs.openstack.org/infra/manual/developers.html#development-workflow
 and follow the instructions there to upload your change to Gerrit.
 """
 
+WORKERS = 4
+# Results per page of the search API, 100 is the most GitHub allows
+PER_PAGE = 100
+# API calls left over for anything else using the same account
+RATE_LIMIT_RESERVE = 100
+# GitHub returns at most this many results of a search
+SEARCH_MAX_RESULTS = 1000
+# Searches left over, the search limit is only 30 calls a minute
+SEARCH_RATE_LIMIT_RESERVE = 0
+
 log = logging.getLogger("close_pull_requests")
 
 
+class RateLimiter(object):
+    """Hand out GitHub API calls while staying within the rate limit.
+
+    When the calls left would drop below reserve, acquire() blocks until
+    the limit is reset. calls counts the calls handed out. resource is
+    the rate limit to use, 'core' or the separate 'search' limit.
+    """
+
+    def __init__(self, ghub, reserve=RATE_LIMIT_RESERVE, resource='core'):
+        self.ghub = ghub
+        self.reserve = reserve
+        self.resource = resource
+        self.lock = threading.Lock()
+        self.calls = 0
+        self._refresh()
+
+    def _refresh(self):
+        # Does not count against the rate limit
+        limits = self.ghub.get_rate_limit()
+        rate = getattr(limits, self.resource, None) or limits.rate
+        self.remaining = rate.remaining
+        self.reset = calendar.timegm(rate.reset.timetuple())
+
+    def acquire(self, calls):
+        with self.lock:
+            while self.remaining - calls < self.reserve:
+                delay = self.reset - time.time()
+                if delay <= 0:
+                    # Nothing to wait for, the limit is just that low
+                    break
+                log.info("Rate limit reached, waiting %ds" % delay)
+                time.sleep(delay + 1)
+                self._refresh()
+            self.remaining -= calls
+            self.calls += calls
+
+
+def open_pull_requests(ghub, owner, qualifier, limiter):
+    """Find the open pull requests in the repos of owner.
+
+    Returns a list of (repo, issue), where repo is the lower case full
+    name of the repository. Each page of results is one call of the
+    search limiter. Repos without open pull requests cost nothing.
+    """
+    found = []
+    results = ghub.search_issues('is:pr is:open %s:%s' % (qualifier, owner))
+    limiter.acquire(1)
+    for index, issue in enumerate(results, 1):
+        # https://github.com/<owner>/<repo>/pull/<number>
+        (repo_owner, repo_name) = issue.html_url.split('/')[3:5]
+        found.append((('%s/%s' % (repo_owner, repo_name)).lower(), issue))
+        if (index % PER_PAGE == 0 and
+                index < min(results.totalCount, SEARCH_MAX_RESULTS)):
+            # Fetching the next issue loads the next page
+            limiter.acquire(1)
+    if results.totalCount > len(found):
+        log.warning("Only %d of the %d open pull requests of %s were found"
+                    % (len(found), results.totalCount, owner))
+    return found
+
+
+def close_pull_request(issue, project, pull_request_text, limiter):
+    # A comment and an edit
+    limiter.acquire(2)
+    try:
+        issue.create_comment(pull_request_text % dict(project=project))
+        issue.edit(state="closed")
+    except github.GithubException:
+        log.exception("Could not close %s" % issue.html_url)
+        return False
+    log.info("Closed %s" % issue.html_url)
+    return True
+
+
 def main():
 
     parser = argparse.ArgumentParser()
     l.setup_logging_arguments(parser)
     parser.add_argument('--message-file', dest='message_file', default=None,
                         help='The close pull request message')
+    parser.add_argument('--workers', dest='workers', type=int,
+                        default=WORKERS,
+                        help='The number of pull requests to close at once')
 
     args = parser.parse_args()
     l.configure_logging(args)
@@ -92,13 +183,17 @@ def main():
     registry = u.ProjectsRegistry()
 
     if secure_config.has_option("github", "oauth_token"):
-        ghub = github.Github(secure_config.get("github", "oauth_token"))
+        ghub = github.Github(secure_config.get("github", "oauth_token"),
+                             per_page=PER_PAGE)
     else:
         ghub = github.Github(secure_config.get("github", "username"),
-                             secure_config.get("github", "password"))
+                             secure_config.get("github", "password"),
+                             per_page=PER_PAGE)
 
-    orgs = ghub.get_user().get_orgs()
-    orgs_dict = dict(zip([o.login.lower() for o in orgs], orgs))
+    # Lower case full repo name -> project
+    projects = {}
+    user_login = None
+    api_calls = 0
     for section in registry.configs_list:
         project = section['project']
 
@@ -110,31 +205,46 @@ def main():
         if 'options' in section and 'has-pull-requests' in section['options']:
             continue
 
-        # Find the project's repo
-        project_split = project.split('/', 1)
-
-        # Handle errors in case the repo or the organization doesn't exists
+        if '/' not in project:
+            # Repos without an org belong to the user
+            if user_login is None:
+                user_login = ghub.get_user().login
+                api_calls += 1
+            projects[('%s/%s' % (user_login, project)).lower()] = project
+        else:
+            projects[project.lower()] = project
+
+    owners = set(name.split('/', 1)[0] for name in projects)
+    to_close = []
+    search_limiter = RateLimiter(ghub, reserve=SEARCH_RATE_LIMIT_RESERVE,
+                                 resource='search')
+    for owner in sorted(owners):
+        qualifier = 'user' if owner == (user_login or '').lower() else 'org'
         try:
-            if len(project_split) > 1:
-                org = orgs_dict[project_split[0].lower()]
-                repo = org.get_repo(project_split[1])
-            else:
-                repo = ghub.get_user().get_repo(project)
-        except (KeyError, github.GithubException):
-            log.exception("Could not find project %s on GitHub." % project)
+            found = open_pull_requests(ghub, owner, qualifier,
+                                       search_limiter)
+        except github.GithubException:
+            log.exception("Could not search pull requests of %s." % owner)
             continue
-
-        # Close each pull request
-        pull_requests = repo.get_pulls("open")
-        for req in pull_requests:
-            vars = dict(project=project)
-            issue_data = {"url": repo.url + "/issues/" + str(req.number)}
-            issue = github.Issue.Issue(requester=req._requester,
-                                       headers={},
-                                       attributes=issue_data,
-                                       completed=True)
-            issue.create_comment(pull_request_text % vars)
-            req.edit(state="closed")
+        for (repo, issue) in found:
+            if repo in projects:
+                to_close.append((issue, projects[repo]))
+
+    limiter = RateLimiter(ghub)
+    workers = pool.ThreadPool(args.workers)
+    try:
+        results = workers.map(
+            lambda item: close_pull_request(item[0], item[1],
+                                            pull_request_text, limiter),
+            to_close)
+    finally:
+        workers.close()
+        workers.join()
+
+    closed = sum(1 for result in results if result)
+    log.info("Closed %d of %d open pull requests using %d API calls"
+             % (closed, len(to_close),
+                api_calls + search_limiter.calls + limiter.calls))
 
 if __name__ == "__main__":
     main()
@@ -19,9 +19,21 @@
 #
 # It also creates the necessary top-level directories for each project
 # organization (openstack, stackforge, etc)
+#
+# Configuration files are only replaced when their content changes, and
+# the repos added to or removed from them are printed, so that cgit caches
+# only need to be flushed when something really changed.
+
+from __future__ import print_function
 
+import grp
+from multiprocessing import pool
 import os
+import pwd
+import shutil
 import subprocess
+import sys
+import tempfile
 
 import jeepyb.utils as u
 
@@ -36,6 +48,7 @@ SCRATCH_GROUP = os.environ.get('SCRATCH_GROUP', 'scratch')
 CGIT_USER = os.environ.get('CGIT_USER', 'cgit')
 CGIT_GROUP = os.environ.get('CGIT_GROUP', 'cgit')
 DEFAULT_ORG = os.environ.get('DEFAULT_ORG', None)
+INIT_WORKERS = int(os.environ.get('INIT_WORKERS', '8'))
 
 
 def clean_string(string):
@@ -48,13 +61,102 @@ def clean_string(string):
     return string.replace('\n', ' ').replace('\r', '')
 
 
-def main():
-    registry = u.ProjectsRegistry(PROJECTS_YAML)
-    gitorgs = {}
+def _lookup_ids(owner, group):
+    try:
+        return (pwd.getpwnam(owner).pw_uid, grp.getgrnam(group).gr_gid)
+    except KeyError:
+        print('Unknown owner %s:%s, not changing ownership'
+              % (owner, group), file=sys.stderr)
+        return None
+
+
+def _chown_tree(path, ids):
+    (uid, gid) = ids
+    os.chown(path, uid, gid)
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            os.lchown(os.path.join(root, name), uid, gid)
+
+
+def create_bare_repos(repos, workers=INIT_WORKERS):
+    """Create bare git repos from a list of (path, owner, group).
+
+    git init is only run once, for a template repo which is then copied
+    into place for each new repo from a pool of threads.
+    """
+    if not repos:
+        return
+    ids = {}
+    for (path, owner, group) in repos:
+        if (owner, group) not in ids:
+            ids[(owner, group)] = _lookup_ids(owner, group)
+        # Made up front, so threads don't race to create shared parents
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+
+    template_dir = tempfile.mkdtemp()
+    template = os.path.join(template_dir, 'template.git')
+    try:
+        subprocess.check_call(['git', 'init', '--quiet', '--bare', template])
+
+        def create(repo):
+            (path, owner, group) = repo
+            shutil.copytree(template, path, symlinks=True)
+            if ids[(owner, group)]:
+                _chown_tree(path, ids[(owner, group)])
+
+        init_pool = pool.ThreadPool(workers)
+        try:
+            init_pool.map(create, repos)
+        finally:
+            init_pool.close()
+            init_pool.join()
+    finally:
+        shutil.rmtree(template_dir)
+
+
+def existing_repos(path):
+    """Return the names of the entries of the directory path."""
+    try:
+        return set(os.listdir(path))
+    except OSError:
+        return set()
+
+
+def repo_urls(text):
+    """Return the set of repo.url values in a cgitrepos file."""
+    return set(line[len('repo.url='):] for line in text.splitlines()
+               if line.startswith('repo.url='))
+
+
+def update_cgit_file(path, content):
+    """Write a cgitrepos file if it changed and report changed repos."""
+    try:
+        with open(path) as cgit_file:
+            old_urls = repo_urls(cgit_file.read())
+    except IOError:
+        old_urls = set()
+    if not u.write_if_changed(path, content):
+        return False
+    new_urls = repo_urls(content)
+    for url in sorted(new_urls - old_urls):
+        print('Added %s to %s' % (url, path))
+    for url in sorted(old_urls - new_urls):
+        print('Removed %s from %s' % (url, path))
+    return True
+
+
+def project_records(configs_list):
+    """Return the projects as (org, name, project, description, alias).
+
+    alias is the (site, path) of the project's cgit alias, or None. The
+    records are sorted by org and name, which is the order they are
+    rendered in everywhere.
+    """
+    records = []
     names = set()
-    # site -> [(path, project, description)]
-    alias_sites = {}
-    for entry in registry.configs_list:
+    for entry in configs_list:
         project = entry['project']
         if '/' in project:
             (org, name) = project.split('/')
@@ -66,54 +168,82 @@ def main():
         description = entry.get('description', name)
         assert project not in names
         names.add(project)
-        gitorgs.setdefault(org, []).append((name, description))
+        alias = None
         if 'cgit-alias' in entry:
-            alias_site = entry['cgit-alias']['site']
-            alias_path = entry['cgit-alias']['path']
-            alias_sites.setdefault(alias_site, []).append(
-                (alias_path, project, description))
+            alias = (entry['cgit-alias']['site'], entry['cgit-alias']['path'])
+        records.append((org, name, project, description, alias))
+    records.sort(key=lambda record: (record[0], record[1]))
+    return records
+
+
+def render_repo(url, path, description):
+    return ('\nrepo.url=%s\nrepo.path=%s/\nrepo.desc=%s\n'
+            % (url, path, clean_string(description)))
+
+
+def render_cgitrepos(records):
+    """Yield the cgitrepos file for the sorted records, org by org."""
+    yield '# Autogenerated by create_cgitrepos.py\n'
+    section = None
+    for (org, name, project, description, alias) in records:
+        if org != section:
+            section = org
+            yield '\nsection=%s\n' % (org)
+        project_repo = "%s.git" % os.path.join(REPO_PATH, org, name)
+        yield render_repo('%s/%s' % (org, name), project_repo, description)
+
+
+def render_alias_site(aliases):
+    """Yield the cgitrepos file of an alias site."""
+    yield '# Autogenerated by create_cgitrepos.py\n'
+    for (alias_path, project, description) in aliases:
+        project_repo = "%s.git" % os.path.join(REPO_PATH, project)
+        yield render_repo(alias_path, project_repo, description)
+
+
+def missing_repos(base_path, records, owner, group):
+    """Return (path, owner, group) of the repos not yet under base_path."""
+    missing = []
+    existing = None
+    section = None
+    for (org, name, project, description, alias) in records:
+        org_dir = os.path.join(base_path, org)
+        if org != section:
+            section = org
+            if not os.path.isdir(org_dir):
+                os.makedirs(org_dir)
+            existing = existing_repos(org_dir)
+        if "%s.git" % name not in existing:
+            missing.append(
+                ("%s.git" % os.path.join(org_dir, name), owner, group))
+    return missing
+
+
+def main():
+    registry = u.ProjectsRegistry(PROJECTS_YAML)
+    records = project_records(registry.configs_list)
+    # site -> [(path, project, description)]
+    alias_sites = {}
+    for (org, name, project, description, alias) in records:
+        if alias:
+            alias_sites.setdefault(alias[0], []).append(
+                (alias[1], project, description))
+    new_repos = []
     if SCRATCH_SUBPATH:
-        assert SCRATCH_SUBPATH not in gitorgs
+        assert SCRATCH_SUBPATH not in set(record[0] for record in records)
         scratch_path = os.path.join(REPO_PATH, SCRATCH_SUBPATH)
-        for org in gitorgs:
-            scratch_dir = os.path.join(scratch_path, org)
-            if not os.path.isdir(scratch_dir):
-                os.makedirs(scratch_dir)
-            projects = gitorgs[org]
-            for (name, description) in projects:
-                scratch_repo = "%s.git" % os.path.join(scratch_dir, name)
-                subprocess.call(['git', 'init', '--bare', scratch_repo])
-                subprocess.call(['chown', '-R', '%s:%s'
-                                 % (SCRATCH_OWNER, SCRATCH_GROUP),
-                                 scratch_repo])
-    for org in gitorgs:
-        if not os.path.isdir('%s/%s' % (REPO_PATH, org)):
-            os.makedirs('%s/%s' % (REPO_PATH, org))
-    with open(CGIT_REPOS, 'w') as cgit_file:
-        cgit_file.write('# Autogenerated by create_cgitrepos.py\n')
-        for org in sorted(gitorgs):
-            cgit_file.write('\n')
-            cgit_file.write('section=%s\n' % (org))
-            org_dir = os.path.join(REPO_PATH, org)
-            projects = gitorgs[org]
-            projects.sort()
-            for (name, description) in projects:
-                project_repo = "%s.git" % os.path.join(org_dir, name)
-                cgit_file.write('\n')
-                cgit_file.write('repo.url=%s/%s\n' % (org, name))
-                cgit_file.write('repo.path=%s/\n' % (project_repo))
-                cgit_file.write(
-                    'repo.desc=%s\n' % (clean_string(description)))
-                if not os.path.exists(project_repo):
-                    subprocess.call(['git', 'init', '--bare', project_repo])
-                    subprocess.call(['chown', '-R', '%s:%s'
-                                     % (CGIT_USER, CGIT_GROUP), project_repo])
-    for alias_site, aliases in alias_sites.items():
+        new_repos.extend(missing_repos(scratch_path, records,
+                                       SCRATCH_OWNER, SCRATCH_GROUP))
+    new_repos.extend(missing_repos(REPO_PATH, records,
+                                   CGIT_USER, CGIT_GROUP))
+    create_bare_repos(new_repos)
+    update_cgit_file(CGIT_REPOS, ''.join(render_cgitrepos(records)))
+    for alias_site, aliases in sorted(alias_sites.items()):
         # Create all the symlinks for this alias site first
+        alias_site_root = os.path.join(ALIAS_PATH, alias_site)
+        if not os.path.exists(alias_site_root):
+            os.makedirs(alias_site_root)
         for (alias_path, project, description) in aliases:
-            alias_site_root = os.path.join(ALIAS_PATH, alias_site)
-            if not os.path.exists(alias_site_root):
-                os.makedirs(alias_site_root)
             alias_link_path = os.path.join(alias_site_root, alias_path)
             alias_link_path += '.git'
             alias_repo_path = os.path.join(REPO_PATH, project)
@@ -122,15 +252,7 @@ def main():
                 os.symlink(alias_repo_path, alias_link_path)
         # Then create the cgit repo config
         cgit_path = CGIT_REPOS + '_' + alias_site
-        with open(cgit_path, 'w') as cgit_file:
-            cgit_file.write('# Autogenerated by create_cgitrepos.py\n')
-            for (alias_path, project, description) in aliases:
-                project_repo = "%s.git" % os.path.join(REPO_PATH, project)
-                cgit_file.write('\n')
-                cgit_file.write('repo.url=%s\n' % (alias_path,))
-                cgit_file.write('repo.path=%s/\n' % (project_repo,))
-                cgit_file.write(
-                    'repo.desc=%s\n' % (clean_string(description)))
+        update_cgit_file(cgit_path, ''.join(render_alias_site(aliases)))
 
 
 if __name__ == "__main__":
@@ -15,7 +15,21 @@
 #
 # create_hound_config.py reads the project config file called projects.yaml
 # and generates a hound configuration file.
+#
+# Repos are named after the basename of their project, or after the full
+# project name when several projects share a basename. A project which
+# already has the basename in the existing config keeps it, so only the
+# newcomers are renamed and reindexed. The config is only
+# rewritten when it changes, and the repos added or removed are printed.
+#
+# With --shards N the repos are also split across N config files, balanced
+# by the size of the repos found under --repo-root, so that several hound
+# instances can index them in parallel.
 
+from __future__ import print_function
+
+import argparse
+import heapq
 import json
 import os
 
@@ -28,10 +42,7 @@ DATA_PATH = os.environ.get('DATA_PATH', 'data')
 GIT_PROTOCOL = os.environ.get('GIT_PROTOCOL', 'git://')
 
 
-def main():
-    registry = u.ProjectsRegistry(PROJECTS_YAML)
-    projects = [entry['project'] for entry in registry.configs_list]
-    repos = {}
+def indexed_projects(projects):
     for project in projects:
         # Ignore attic and stackforge, those are repos that are not
         # active anymore.
@@ -43,27 +54,150 @@ def main():
         # interest to upstream developers
         if basename.startswith('deb-'):
             continue
-        repos[basename] = {
-            'url': "%(proto)s%(gitbase)s/%(project)s" % dict(
-                proto=GIT_PROTOCOL, gitbase=GIT_SERVER, project=project),
-            'url-pattern': {
-                'base-url': "http://%(gitbase)s/cgit/%(project)s"
-                            "/tree/{path}{anchor}" % dict(gitbase=GIT_SERVER,
-                                                          project=project),
-                'anchor': '#n{line}',
-            }
+        yield project
+
+
+def repo_names(projects, previous=None):
+    """Return a dict of project to its repo name in the hound config.
+
+    previous is the repos of the existing config, used to keep the name
+    of a project which already has its basename.
+    """
+    previous = previous or {}
+    by_basename = {}
+    for project in projects:
+        by_basename.setdefault(os.path.basename(project), []).append(project)
+    names = {}
+    for basename, colliding in sorted(by_basename.items()):
+        if len(colliding) > 1:
+            old_url = previous.get(basename, {}).get('url')
+            keeper = None
+            for project in colliding:
+                if repo_config(project)['url'] == old_url:
+                    keeper = project
+            print('Repo name %s is shared by %s, using full names'
+                  % (basename, ', '.join(sorted(colliding))))
+            for project in colliding:
+                names[project] = project
+            if keeper:
+                print('Keeping repo name %s for %s' % (basename, keeper))
+                names[keeper] = basename
+        else:
+            names[colliding[0]] = basename
+    return names
+
+
+def repo_config(project):
+    return {
+        'url': "%(proto)s%(gitbase)s/%(project)s" % dict(
+            proto=GIT_PROTOCOL, gitbase=GIT_SERVER, project=project),
+        'url-pattern': {
+            'base-url': "http://%(gitbase)s/cgit/%(project)s"
+                        "/tree/{path}{anchor}" % dict(gitbase=GIT_SERVER,
+                                                      project=project),
+            'anchor': '#n{line}',
         }
+    }
+
+
+def repo_size(repo_root, project):
+    """Return the size on disk of the repo of project under repo_root."""
+    for path in (os.path.join(repo_root, project + '.git'),
+                 os.path.join(repo_root, project)):
+        if os.path.isdir(path):
+            break
+    else:
+        return 0
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
 
+
+def shard_repos(repos, sizes, count):
+    """Split repos into count dicts with about the same total size.
+
+    Repos are handed out largest first, each to the shard which is
+    smallest so far.
+    """
+    shards = [{} for i in range(count)]
+    heap = [(0, i) for i in range(count)]
+    by_size = sorted(repos, key=lambda name: (-sizes.get(name, 0), name))
+    for name in by_size:
+        (total, i) = heapq.heappop(heap)
+        shards[i][name] = repos[name]
+        # Unknown sizes count as one so they still spread out
+        heapq.heappush(heap, (total + max(sizes.get(name, 0), 1), i))
+    return shards
+
+
+def shard_path(path, index):
+    (root, ext) = os.path.splitext(path)
+    return '%s-%d%s' % (root, index, ext)
+
+
+def read_repos(path):
+    """Return the repos of an existing hound config, if any."""
+    try:
+        with open(path) as config_file:
+            return json.load(config_file).get('repos', {})
+    except (IOError, ValueError):
+        return {}
+
+
+def write_config(path, repos, dbpath="data"):
+    """Write a hound config if it changed, printing changed repos."""
+    old_repos = set(read_repos(path))
     config = {
-        "dbpath": "data",
+        "dbpath": dbpath,
         "repos": repos
     }
-    with open('config.json', 'w') as config_file:
-        config_file.write(
-            json.dumps(
-                config, indent=2,
-                separators=(',', ': '), sort_keys=False,
-                default=unicode))
+    # Sorted keys keep the file stable when the repos are unchanged
+    content = json.dumps(
+        config, indent=2,
+        separators=(',', ': '), sort_keys=True,
+        default=unicode)
+    if not u.write_if_changed(path, content):
+        return
+    for name in sorted(set(repos) - old_repos):
+        print('Added %s to %s' % (name, path))
+    for name in sorted(old_repos - set(repos)):
+        print('Removed %s from %s' % (name, path))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', default='config.json',
+                        help='The hound config file to write')
+    parser.add_argument('--shards', type=int, default=0,
+                        help='Also split the repos across this many '
+                             'config files')
+    parser.add_argument('--repo-root',
+                        help='Where the repos are, to balance shards '
+                             'by size')
+    args = parser.parse_args()
+
+    registry = u.ProjectsRegistry(PROJECTS_YAML)
+    projects = list(indexed_projects(
+        entry['project'] for entry in registry.configs_list))
+    names = repo_names(projects, read_repos(args.output))
+    repos = dict((names[project], repo_config(project))
+                 for project in projects)
+    write_config(args.output, repos)
+
+    if args.shards > 1:
+        sizes = {}
+        if args.repo_root:
+            for project in projects:
+                sizes[names[project]] = repo_size(args.repo_root, project)
+        shards = shard_repos(repos, sizes, args.shards)
+        for i, shard in enumerate(shards):
+            write_config(shard_path(args.output, i), shard,
+                         dbpath='data-%d' % i)
 
 
 if __name__ == "__main__":
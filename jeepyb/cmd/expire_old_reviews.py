@@ -20,13 +20,68 @@
 import argparse
 import json
 import logging
-import paramiko
+from multiprocessing import pool
+import time
 
+import jeepyb.gerrit_ssh as gerrit_ssh
 import jeepyb.log as l
 
+# Gerrit caps the results of a single query, 500 by default
+PAGE_SIZE = 250
+WORKERS = 4
+# Labels whose negative votes make a change expirable
+LABELS = 'Code-Review,Verified,Workflow'
+
 logger = logging.getLogger('expire_reviews')
 
 
+def query_changes(ssh, query, page_size=PAGE_SIZE, page_done=None):
+    """Yield the changes matching query, fetching page_size at a time.
+
+    The query is repeated with --start until Gerrit says there are no
+    more changes, each page is parsed as it is read from the channel.
+    page_done is called after each page and returns how many of its
+    changes no longer match the query, so the next page does not skip
+    over any.
+    """
+    start = 0
+    while True:
+        stdin, stdout, stderr = ssh.exec_command(
+            'gerrit query --format JSON --start %d %s limit:%d'
+            % (start, query, page_size))
+        rows = 0
+        more = False
+        for line in stdout:
+            row = json.loads(line)
+            if row.get('type') == 'error':
+                logger.error('Query failed: %s', row.get('message'))
+                return
+            if 'rowCount' in row:
+                # moreChanges is only reported since Gerrit 2.9
+                more = row.get('moreChanges', row['rowCount'] >= page_size)
+                continue
+            rows += 1
+            yield row
+        if stdout.channel.recv_exit_status() != 0:
+            logger.error('Query failed: %s', stderr.read())
+            return
+        removed = page_done() if page_done else 0
+        if not more or not rows:
+            return
+        start += rows - removed
+
+
+def expiry_query(age, labels):
+    """Return the query for changes with a negative vote on a label.
+
+    Gerrit only matches votes on the current patch set, so only that
+    patch set needs to be sent back.
+    """
+    votes = ' OR '.join('label:%s<=-1' % label for label in labels)
+    return ('--current-patch-set status:reviewed age:%s (%s)'
+            % (age, votes))
+
+
 def expire_patch_set(ssh, patch_id, patch_subject):
     message = ('Code review expired due to no recent activity'
                ' after a negative review. It can be restored using'
@@ -38,9 +93,11 @@ def expire_patch_set(ssh, patch_id, patch_subject):
                    patch_id=patch_id)
 
     logger.info('Expiring: %s - %s: %s', patch_id, patch_subject, message)
-    stdin, stdout, stderr = ssh.exec_command(command)
-    if stdout.channel.recv_exit_status() != 0:
-        logger.error(stderr.read())
+    status, out, err = ssh.run(command)
+    if status != 0:
+        logger.error(err)
+        return False
+    return True
 
 
 def main():
@@ -50,6 +107,17 @@ def main():
     parser.add_argument('ssh_key', help='The gerrit admin SSH key file')
     parser.add_argument('--age', dest='age', default='1w',
                         help='The minimum age of a review to expire')
+    parser.add_argument('--page-size', dest='page_size', type=int,
+                        default=PAGE_SIZE,
+                        help='The number of changes to query at a time')
+    parser.add_argument('--workers', dest='workers', type=int,
+                        default=WORKERS,
+                        help='The number of changes to abandon at once')
+    parser.add_argument('--labels', dest='labels', default=LABELS,
+                        help='Comma separated labels to look for negative '
+                             'votes on')
+    parser.add_argument('--dry-run', dest='dry_run', action='store_true',
+                        help='Only report the changes which would expire')
     l.setup_logging_arguments(parser)
     options = parser.parse_args()
     l.configure_logging(options)
@@ -61,28 +129,66 @@ def main():
     logger.info('Starting expire reviews')
     logger.info('Connecting to Gerrit')
 
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect('localhost', username=GERRIT_USER,
-                key_filename=GERRIT_SSH_KEY, port=29418)
+    ssh = gerrit_ssh.get_connection('localhost', username=GERRIT_USER,
+                                    key_filename=GERRIT_SSH_KEY, port=29418)
+
+    workers = pool.ThreadPool(options.workers)
+    pending = []
+    stats = dict(scanned=0, would_expire=0, expired=0, failed=0, pages=0,
+                 abandon_wait=0.0)
+
+    def page_done():
+        # Wait for this page's abandons, they drop out of the query
+        # results and shift the start of the next page.
+        wait_start = time.time()
+        expired = 0
+        for result in pending:
+            if result.get():
+                expired += 1
+            else:
+                stats['failed'] += 1
+        del pending[:]
+        stats['abandon_wait'] += time.time() - wait_start
+        stats['expired'] += expired
+        stats['pages'] += 1
+        return expired
 
     # Query all reviewed with no activity for 1 week
     logger.info('Searching no activity on negative review for 1 week')
-    stdin, stdout, stderr = ssh.exec_command(
-        'gerrit query --current-patch-set --all-approvals'
-        ' --format JSON status:reviewed age:' + EXPIRY_AGE)
-
-    for line in stdout:
-        row = json.loads(line)
-        if 'rowCount' not in row and 'open' in row and row['open']:
-            # Search for negative approvals
-            for approval in row['currentPatchSet']['approvals']:
-                if approval['value'] in ('-1', '-2'):
-                    expire_patch_set(ssh,
-                                     row['currentPatchSet']['revision'],
-                                     row['subject'])
-                    break
-
+    start_time = time.time()
+    labels = [label.strip() for label in options.labels.split(',')
+              if label.strip()]
+    query = expiry_query(EXPIRY_AGE, labels)
+    try:
+        for row in query_changes(ssh, query, options.page_size, page_done):
+            stats['scanned'] += 1
+            if not row.get('open'):
+                continue
+            # The query only matches changes with negative votes
+            if options.dry_run:
+                stats['would_expire'] += 1
+                logger.info('Would expire: %s - %s',
+                            row.get('url', row['number']), row['subject'])
+                continue
+            pending.append(workers.apply_async(
+                expire_patch_set,
+                (ssh, row['currentPatchSet']['revision'], row['subject'])))
+        # The query may have stopped early on an error
+        if pending:
+            page_done()
+    finally:
+        workers.close()
+        workers.join()
+        ssh.close()
+
+    if options.dry_run:
+        logger.info('Dry run: %d changes would expire, found in %.1fs',
+                    stats['would_expire'], time.time() - start_time)
+    logger.info('Scanned %d changes in %d pages, expired %d, failed %d '
+                'in %.1fs (%.1fs waiting for abandons)',
+                stats['scanned'], stats['pages'], stats['expired'],
+                stats['failed'], time.time() - start_time,
+                stats['abandon_wait'])
     logger.info('End expire review')
 
 if __name__ == "__main__":
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# Copyright (c) 2016 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# This sends the mail queued by notify-impact --spool-dir over a single
+# SMTP session. It is intended to be run periodically, for example every
+# few minutes via cron:
+#
+#     flush-impact-mail --spool-dir /var/spool/notify-impact \
+#         --digest-window 3600 --smtp-host localhost
+#
+# With --digest-window, the mails for each destination address are
+# combined into one digest per window, sent once the window has closed.
+
+import argparse
+import logging
+
+import jeepyb.log as l
+from jeepyb import mailspool
+
+log = logging.getLogger('flush_impact_mail')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Send mail queued by notify-impact')
+    parser.add_argument('--spool-dir', dest='spool_dir', required=True)
+    parser.add_argument('--digest-window', dest='digest_window', type=int,
+                        default=None,
+                        help='combine mail per destination over windows of '
+                             'this many seconds')
+    mailspool.setup_smtp_arguments(parser)
+    l.setup_logging_arguments(parser)
+    args = parser.parse_args()
+    l.configure_logging(args)
+
+    spool = mailspool.MailSpool(args.spool_dir)
+    sent = spool.flush(lambda: mailspool.smtp_connection(args),
+                       digest_window=args.digest_window)
+    log.info("Sent %d queued messages" % sent)
+
+
+if __name__ == "__main__":
+    main()
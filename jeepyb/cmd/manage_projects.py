@@ -187,16 +187,10 @@ def _get_group_uuid(group, retries=10):
 
     Wait for up to 10 seconds for the group to be created in the DB.
     """
-    query = "SELECT group_uuid FROM account_groups WHERE name = %s"
-    con = jeepyb.gerritdb.connect()
     for x in range(retries):
-        cursor = con.cursor()
-        cursor.execute(query, (group,))
-        data = cursor.fetchone()
-        cursor.close()
-        con.commit()
-        if data:
-            return data[0]
+        uuid = jeepyb.gerritdb.get_group_uuid(group)
+        if uuid:
+            return uuid
         if retries > 1:
             time.sleep(1)
     return None
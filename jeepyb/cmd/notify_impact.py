@@ -33,22 +33,20 @@ from __future__ import print_function
 import argparse
 import logging
 import os
-import re
-import smtplib
-import subprocess
 
-from email.mime import text
 from launchpadlib import launchpad
 from launchpadlib import uris
 import yaml
 
+from jeepyb import commitmsg
+from jeepyb import gitlog
+from jeepyb import mailspool
 from jeepyb import projects
 
 
 logger = logging.getLogger('notify_impact')
 
 DOC_TAG = "doc"
-BASE_DIR = '/home/gerrit2/review_site'
 EMAIL_TEMPLATE = """
 Hi, I'd like you to take a look at this patch for potential
 %s.
@@ -65,6 +63,55 @@ GERRIT_CREDENTIALS = os.path.expanduser(
     os.environ.get('GERRIT_CREDENTIALS',
                    '~/.launchpadlib/creds'))
 
+# filename -> (mtime, parsed config)
+_config_cache = {}
+
+
+class AuthorMap(object):
+    """Map commit author email addresses to author classes.
+
+    Keys are matched case insensitively against the whole email
+    address, except keys ending with '*' which match any address
+    starting with the rest of the key.
+    """
+
+    def __init__(self, author_map):
+        self.exact = {}
+        self.prefixes = []
+        for key, author_class in author_map.items():
+            key = key.lower()
+            if key.endswith('*'):
+                self.prefixes.append((key[:-1], author_class))
+            else:
+                self.exact[key] = author_class
+        # Longest prefix wins
+        self.prefixes.sort(key=lambda prefix: len(prefix[0]), reverse=True)
+
+    def match(self, authors):
+        """Return the class of the first matching (name, email) author."""
+        for name, email in authors:
+            email = email.lower()
+            if email in self.exact:
+                return self.exact[email]
+            for prefix, author_class in self.prefixes:
+                if email.startswith(prefix):
+                    return author_class
+        return None
+
+
+def load_config(filename):
+    """Load the subscriber config, reusing it until the file changes."""
+    mtime = os.stat(filename).st_mtime
+    cached = _config_cache.get(filename)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    with open(filename, 'r') as config_file:
+        config = yaml.safe_load(config_file) or {}
+    config['author_map'] = AuthorMap(config.get('author_map') or {})
+    _config_cache[filename] = (mtime, config)
+    return config
+
 
 class BugActionsReal(object):
     """Things we do to bugs."""
@@ -109,7 +156,7 @@ class BugActionsDryRun(object):
               'but I am in dry run mode' % subscriber)
 
 
-def create_bug(git_log, args, config):
+def create_bug(git_log, message, args, config):
     """Create a bug for a change.
 
     Create a launchpad bug in a LP project, titled with the first line of
@@ -154,7 +201,6 @@ def create_bug(git_log, args, config):
     project = lpconn.projects[lp_project]
 
     buglink = None
-    author_class = None
 
     buginfo, buglink = actions.create(project, bug_title, bug_descr, args)
     logger.info('Created a bug in project %(project)s with title "%(title)s": '
@@ -165,12 +211,8 @@ def create_bug(git_log, args, config):
 
     # If the author of the merging patch matches our configured
     # subscriber lists, then subscribe the configured victims.
-    for email_address in config.get('author_map', {}):
-        email_re = re.compile('^Author:.*%s.*' % email_address)
-        for line in bug_descr.split('\n'):
-            m = email_re.match(line)
-            if m:
-                author_class = config['author_map'][email_address]
+    author_map = config.get('author_map', AuthorMap({}))
+    author_class = author_map.match(message.authors)
 
     if author_class:
         config = config.get('subscriber_map', {}).get(author_class, [])
@@ -183,29 +225,7 @@ def create_bug(git_log, args, config):
     return buglink
 
 
-def smtp_connection(args):
-    """Create SMTP connection based on command line arguments, falling
-    back to sensible defaults if no arguments are provided.
-    """
-    conn = None
-    if args.smtp_ssl:
-        port = 465 if not args.smtp_port else args.smtp_port
-        conn = smtplib.SMTP_SSL(args.smtp_host, port)
-    else:
-        port = 25 if not args.smtp_port else args.smtp_port
-        conn = smtplib.SMTP(args.smtp_host, port)
-
-    if args.smtp_starttls:
-        conn.starttls()
-        conn.ehlo()
-
-    if args.smtp_user and args.smtp_pass:
-        conn.login(args.smtp_user, args.smtp_pass)
-
-    return conn
-
-
-def process_impact(git_log, args, config):
+def process_impact(git_log, message, args, config):
     """Process DocImpact flag.
 
     If the 'DocImpact' flag is present for a change that is merged,
@@ -216,34 +236,32 @@ def process_impact(git_log, args, config):
     """
     if args.impact.lower() == 'docimpact':
         if args.hook == "change-merged":
-            create_bug(git_log, args, config)
+            create_bug(git_log, message, args, config)
         return
 
     email_content = EMAIL_TEMPLATE % (args.impact,
                                       args.change_url, git_log)
 
-    msg = text.MIMEText(email_content)
-    msg['Subject'] = '[%s] %s review request change %s' % \
+    subject = '[%s] %s review request change %s' % \
         (args.project, args.impact, args.change)
-    msg['From'] = args.smtp_from
-    msg['To'] = args.dest_address
 
-    s = smtp_connection(args)
+    if args.spool_dir:
+        # Leave delivery to flush-impact-mail
+        spool = mailspool.MailSpool(args.spool_dir)
+        spool.enqueue(args.smtp_from, args.dest_address,
+                      subject, email_content)
+        return
+
+    msg = mailspool.make_message(args.smtp_from, args.dest_address,
+                                 subject, email_content)
+    s = mailspool.smtp_connection(args)
     s.sendmail(args.smtp_from, args.dest_address, msg.as_string())
     s.quit()
 
 
-def impacted(git_log, impact_string):
+def impacted(message, impact_string):
     """Determine if a changes log indicates there is an impact."""
-    return re.search(impact_string, git_log, re.IGNORECASE)
-
-
-def extract_git_log(args):
-    """Extract git log of all merged commits."""
-    cmd = ['git',
-           '--git-dir=' + BASE_DIR + '/git/' + args.project + '.git',
-           'log', '--no-merges', args.commit + '^1..' + args.commit]
-    return subprocess.Popen(cmd, stdout=subprocess.PIPE).communicate()[0]
+    return message.has_impact(impact_string)
 
 
 def main():
@@ -279,8 +297,7 @@ def main():
 
     # Automatic config: config contains a mapping of email addresses to
     # subscribers.
-    parser.add_argument('--config', type=argparse.FileType('r'),
-                        default=None)
+    parser.add_argument('--config', default=None)
 
     # Don't actually create the bug
     parser.add_argument('--dryrun', dest='dryrun', action='store_true')
@@ -288,20 +305,10 @@ def main():
     parser.set_defaults(dryrun=False)
 
     # SMTP configuration
-    parser.add_argument('--smtp-from', dest='smtp_from',
-                        default='gerrit2@review.openstack.org')
-
-    parser.add_argument('--smtp-host', dest='smtp_host', default="localhost")
-    parser.add_argument('--smtp-port', dest='smtp_port')
+    mailspool.setup_smtp_arguments(parser)
 
-    parser.add_argument('--smtp-ssl', dest='smtp_ssl', action='store_true')
-    parser.add_argument('--smtp-starttls', dest='smtp_starttls',
-                        action='store_true')
-
-    parser.add_argument('--smtp-user', dest='smtp_user',
-                        default=os.getenv('SMTP_USER'))
-    parser.add_argument('--smtp-pass', dest='smtp_pass',
-                        default=os.getenv('SMTP_PASS'))
+    # Queue mail for flush-impact-mail instead of sending it
+    parser.add_argument('--spool-dir', dest='spool_dir', default=None)
 
     args = parser.parse_args()
 
@@ -320,17 +327,22 @@ def main():
     #
     # Where the entries in the author map are email addresses
     # to match in author lines, and the subscriber map is a
-    # list of launchpad user ids.
+    # list of launchpad user ids. An author map entry ending
+    # with '*' matches every address starting with it, for
+    # example 'mikal@*'.
     config = {}
     if args.config:
-        config = yaml.load(args.config.read())
+        config = load_config(args.config)
 
     # Get git log
-    git_log = extract_git_log(args)
+    git_log = gitlog.extract_git_log(args.project, args.commit,
+                                     cache_dir=projects.cache_path('gitlog'))
+
+    message = commitmsg.parse(git_log)
 
     # Process impacts found in git log
-    if impacted(git_log, args.impact):
-        process_impact(git_log, args, config)
+    if impacted(message, args.impact):
+        process_impact(git_log, message, args, config)
 
 if __name__ == "__main__":
     main()
@@ -17,6 +17,11 @@
 # to various gerrit tracked projects. It is intended to be run periodically,
 # for example hourly via cron. It takes an optional argument to specify the
 # path to a configuration file.
+#
+# If state_file is set in the [general] section, the changes seen so far are
+# kept there between runs. Only the changes updated since the last run are
+# read from the query results, and a feed is only uploaded again when its
+# content has changed.
 # -*- encoding: utf-8 -*-
 
 from __future__ import print_function
@@ -25,19 +30,27 @@ __author__ = "Chmouel Boudjnah <chmouel@chmouel.com>"
 
 import ConfigParser
 import cStringIO
-import datetime
+from email import utils as email_utils
+import hashlib
 import json
+from multiprocessing import pool
 import os
 import sys
-import time
+import threading
+from xml.sax import saxutils
 
-import PyRSS2Gen
+import six.moves.urllib.error as urlerror
 import six.moves.urllib.request as urlrequest
 
 PROJECTS = ['openstack/nova', 'openstack/keystone', 'openstack/swift']
 JSON_URL = 'https://review.openstack.org/query'
 DEBUG = False
 OUTPUT_MODE = 'multiple'
+# The most recently updated changes of each project kept in the state file
+MAX_ITEMS = 500
+ROW_FIELDS = ('id', 'project', 'status', 'subject', 'owner', 'url',
+              'lastUpdated')
+UPLOAD_WORKERS = 4
 
 curdir = os.path.dirname(os.path.realpath(sys.argv[0]))
 
@@ -76,6 +89,7 @@ def parse_ini(inifile):
     ret['debug'] = get_config(config, 'general', 'debug', DEBUG)
     ret['output_mode'] = get_config(config, 'general', 'output_mode',
                                     OUTPUT_MODE)
+    ret['state_file'] = get_config(config, 'general', 'state_file', '')
     return ret
 
 try:
@@ -90,89 +104,323 @@ def debug(msg):
         print(msg)
 
 
-def get_json(project=None):
-    url = CONFIG['json_url']
-    if project:
-        url += "+project:" + project
-    fp = urlrequest.urlretrieve(url)
-    ret = open(fp[0]).read()
-    return ret
+def load_state(path):
+    if not path or not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as state_file:
+            return json.load(state_file)
+    except (IOError, ValueError):
+        debug("Ignoring unreadable state file %s" % path)
+        return {}
+
+
+def save_state(path, state):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as state_file:
+        json.dump(state, state_file)
+    os.rename(tmp_path, path)
+
+
+def query_url():
+    """Return the URL of the query for the changes of all projects.
+
+    Restricting the query to the watched projects keeps quieter projects
+    from being pushed out of the results by the rest of Gerrit.
+    """
+    projects = '+OR+'.join('project:%s' % project
+                           for project in CONFIG['projects'])
+    return CONFIG['json_url'] + '+(' + projects + ')'
+
+
+def get_json(state):
+    """Open the query results for all projects, returns the response.
+
+    The validators of the response are kept in state and sent with the
+    next request, None is returned if the server says nothing changed.
+    """
+    url = query_url()
+    if state.get('url') != url:
+        # The watched projects changed, start over
+        for key in ('url', 'etag', 'last_modified', 'last_updated', 'rows'):
+            state.pop(key, None)
+    request = urlrequest.Request(url)
+    if state.get('etag'):
+        request.add_header('If-None-Match', state['etag'])
+    if state.get('last_modified'):
+        request.add_header('If-Modified-Since', state['last_modified'])
+    try:
+        response = urlrequest.urlopen(request)
+    except urlerror.HTTPError as e:
+        if e.code == 304:
+            return None
+        raise
+    headers = response.info()
+    state['etag'] = headers.get('ETag')
+    state['last_modified'] = headers.get('Last-Modified')
+    state['url'] = url
+    return response
+
 
+def read_lines(response):
+    """Yield the lines of response as they are received."""
+    for line in iter(response.readline, b''):
+        yield line
 
-def parse_json(content):
-    for row in content.splitlines():
+
+def parse_json(lines, since=None):
+    """Yield the rows of the watched projects.
+
+    Results are sorted by most recent update, so reading stops at the
+    first row which is older than since.
+    """
+    for row in lines:
         try:
             json_row = json.loads(row)
         except(ValueError):
             continue
-        if not json_row or 'project' not in json_row or \
-                json_row['project'] not in CONFIG['projects']:
+        if not json_row or 'project' not in json_row:
+            continue
+        if since and json_row['lastUpdated'] < since:
+            break
+        if json_row['project'] not in CONFIG['projects']:
             continue
         yield json_row
 
 
-def upload_to_swift(content, objectname):
+def update_rows(state, rows):
+    """Merge rows into the changes in state, returning all of them."""
+    known = state.setdefault('rows', {})
+    for row in rows:
+        known[row['id']] = dict((k, row[k]) for k in ROW_FIELDS if k in row)
+    ordered = sorted(known.values(), key=lambda row: row['lastUpdated'],
+                     reverse=True)
+    # Keep MAX_ITEMS per project, so busy projects don't push out others
+    per_project = {}
+    kept = []
+    for row in ordered:
+        count = per_project.get(row['project'], 0)
+        if count < MAX_ITEMS:
+            per_project[row['project']] = count + 1
+            kept.append(row)
+    ordered = kept
+    state['rows'] = dict((row['id'], row) for row in ordered)
+    if ordered:
+        state['last_updated'] = ordered[0]['lastUpdated']
+    return ordered
+
+
+def swift_connection(cfg, **kwargs):
     import swiftclient
-    cfg = CONFIG['swift']
-    client = swiftclient.Connection(cfg['auth_url'],
-                                    cfg['username'],
-                                    cfg['password'],
-                                    auth_version=cfg.get('auth_version',
-                                                         '2.0'))
-    try:
-        client.get_container(cfg['container'])
-    except(swiftclient.client.ClientException):
-        client.put_container(cfg['container'])
-        # eventual consistenties
-        time.sleep(1)
-
-    client.put_object(cfg['container'], objectname,
-                      cStringIO.StringIO(content))
-
-
-def generate_rss(content, project=""):
-    title = "OpenStack %s watch RSS feed" % (project)
-    rss = PyRSS2Gen.RSS2(
-        title=title,
-        link="http://github.com/chmouel/openstackwatch.rss",
-        description="The latest reviews about OpenStack, straight "
-                    "from Gerrit.",
-        lastBuildDate=datetime.datetime.now()
-    )
-    for row in parse_json(content):
+    return swiftclient.Connection(cfg['auth_url'],
+                                  cfg['username'],
+                                  cfg['password'],
+                                  auth_version=cfg.get('auth_version',
+                                                       '2.0'),
+                                  **kwargs)
+
+
+def _not_found(e):
+    # swiftclient.ClientException, without needing swiftclient here
+    return getattr(e, 'http_status', None) == 404
+
+
+class SwiftUploader(object):
+    """Upload objects to the configured container from a pool of threads.
+
+    Only the first connection authenticates, the others reuse its token.
+    The container is checked for once per run. Objects whose ETag already
+    matches their content are not uploaded again.
+
+    connect(cfg, **kwargs) is called to open each connection, so a
+    stand-in for Swift can be used instead of swiftclient.
+    """
+
+    def __init__(self, cfg, connect=swift_connection,
+                 workers=UPLOAD_WORKERS):
+        self.cfg = cfg
+        self.container = cfg['container']
+        self.connect = connect
+        self.auth = None
+        self.container_ready = False
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.pool = pool.ThreadPool(workers)
+
+    def _connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            return conn
+        with self.lock:
+            if self.auth is None:
+                conn = self.connect(self.cfg)
+                self.auth = conn.get_auth()
+        if conn is None:
+            url, token = self.auth
+            conn = self.connect(self.cfg, preauthurl=url, preauthtoken=token)
+        self.local.conn = conn
+        return conn
+
+    def _ensure_container(self, conn):
+        with self.lock:
+            if self.container_ready:
+                return
+            try:
+                conn.head_container(self.container)
+            except Exception as e:
+                if not _not_found(e):
+                    raise
+                conn.put_container(self.container)
+            self.container_ready = True
+
+    def _upload(self, content, objectname):
+        conn = self._connection()
+        self._ensure_container(conn)
+        digest = hashlib.md5(content).hexdigest()
+        try:
+            headers = conn.head_object(self.container, objectname)
+        except Exception as e:
+            if not _not_found(e):
+                raise
+            headers = {}
+        if headers.get('etag') == digest:
+            debug("%s is already up to date" % objectname)
+            return
+        conn.put_object(self.container, objectname, content, etag=digest)
+
+    def upload(self, content, objectname):
+        """Queue content for upload, returns its AsyncResult."""
+        return self.pool.apply_async(self._upload, (content, objectname))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def _text_element(xml, name, text):
+    xml.startElement(name, {})
+    xml.characters(text)
+    xml.endElement(name)
+
+
+def _rfc822(timestamp):
+    return email_utils.formatdate(timestamp, usegmt=True)
+
+
+def write_rss(out, rows, project=""):
+    """Write the RSS feed of rows, newest first, to the file object out.
+
+    Items are written out one at a time as they are generated. The build
+    date is that of the newest row rather than the current time, so that
+    the feed only changes when its content does.
+    """
+    xml = saxutils.XMLGenerator(out, 'utf-8')
+    xml.startDocument()
+    xml.startElement('rss', {'version': '2.0'})
+    xml.startElement('channel', {})
+    _text_element(xml, 'title', "OpenStack %s watch RSS feed" % (project))
+    _text_element(xml, 'link', "http://github.com/chmouel/openstackwatch.rss")
+    _text_element(xml, 'description', "The latest reviews about OpenStack, "
+                                      "straight from Gerrit.")
+    if rows:
+        _text_element(xml, 'lastBuildDate', _rfc822(rows[0]['lastUpdated']))
+    for row in rows:
         author = row['owner']['name']
         author += " <%s>" % ('email' in row['owner'] and
                              row['owner']['email']
                              or row['owner']['username'])
-        rss.items.append(
-            PyRSS2Gen.RSSItem(
-                title="%s [%s]: %s" % (os.path.basename(row['project']),
+        xml.startElement('item', {})
+        _text_element(xml, 'title',
+                      "%s [%s]: %s" % (os.path.basename(row['project']),
                                        row['status'],
-                                       row['subject']),
-                author=author,
-                link=row['url'],
-                guid=PyRSS2Gen.Guid(row['id']),
-                description=row['subject'],
-                pubDate=datetime.datetime.fromtimestamp(row['lastUpdated']),
-            ))
-    return rss.to_xml()
+                                       row['subject']))
+        _text_element(xml, 'link', row['url'])
+        _text_element(xml, 'description', row['subject'])
+        _text_element(xml, 'author', author)
+        _text_element(xml, 'guid', row['id'])
+        _text_element(xml, 'pubDate', _rfc822(row['lastUpdated']))
+        xml.endElement('item')
+    xml.endElement('channel')
+    xml.endElement('rss')
+    xml.endDocument()
+
+
+def publish(rows, objectname, state, uploader, project=""):
+    """Write the feed of rows, returns (objectname, digest, upload).
+
+    upload is the pending upload of the feed, or None if it was printed
+    or has not changed since it was last uploaded.
+    """
+    if uploader is None:
+        write_rss(sys.stdout, rows, project=project)
+        sys.stdout.write('\n')
+        return objectname, None, None
+    buf = cStringIO.StringIO()
+    write_rss(buf, rows, project=project)
+    content = buf.getvalue()
+    digest = hashlib.md5(content).hexdigest()
+    hashes = state.setdefault('hashes', {})
+    if hashes.get(objectname) == digest:
+        debug("%s is unchanged" % objectname)
+        return objectname, digest, None
+    return objectname, digest, uploader.upload(content, objectname)
 
 
 def main():
-    if CONFIG['output_mode'] == "combined":
-        content = generate_rss(get_json())
-        if 'swift' in CONFIG:
-            upload_to_swift(content, CONFIG['swift']['combined_output_object'])
-        else:
-            print(content)
-    elif CONFIG['output_mode'] == "multiple":
-        for project in CONFIG['projects']:
-            content = generate_rss(get_json(project), project=project)
-            if 'swift' in CONFIG:
+    state = load_state(CONFIG['state_file'])
+    response = get_json(state)
+    if response is None:
+        debug("No changes since the last run")
+        return
+    try:
+        rows = update_rows(state,
+                           parse_json(read_lines(response),
+                                      since=state.get('last_updated')))
+    finally:
+        response.close()
+
+    uploader = None
+    if 'swift' in CONFIG:
+        uploader = SwiftUploader(CONFIG['swift'])
+    published = []
+    try:
+        if CONFIG['output_mode'] == "combined":
+            objectname = CONFIG.get('swift', {}).get('combined_output_object')
+            published.append(publish(rows, objectname, state, uploader))
+        elif CONFIG['output_mode'] == "multiple":
+            by_project = {}
+            for row in rows:
+                by_project.setdefault(row['project'], []).append(row)
+            for project in CONFIG['projects']:
                 objectname = "%s.xml" % os.path.basename(project)
-                upload_to_swift(content, objectname)
-            else:
-                print(content)
+                published.append(publish(by_project.get(project, []),
+                                         objectname, state, uploader,
+                                         project=project))
+    finally:
+        if uploader:
+            uploader.close()
+
+    hashes = state.setdefault('hashes', {})
+    failed = False
+    for objectname, digest, upload in published:
+        if upload is None:
+            continue
+        try:
+            upload.get()
+        except Exception as e:
+            print("Failed to upload %s: %s" % (objectname, e),
+                  file=sys.stderr)
+            failed = True
+            continue
+        hashes[objectname] = digest
+    if failed:
+        # Otherwise a 304 would end the next run before the failed
+        # feeds are published again
+        state.pop('etag', None)
+        state.pop('last_modified', None)
+
+    if CONFIG['state_file']:
+        save_state(CONFIG['state_file'], state)
 
 if __name__ == '__main__':
     main()
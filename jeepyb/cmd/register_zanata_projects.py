@@ -15,7 +15,9 @@
 # limitations under the License.
 
 import argparse
+import json
 import logging
+from multiprocessing import pool
 import os
 
 import jeepyb.log as l
@@ -27,30 +29,93 @@ PROJECTS_YAML = os.environ.get('PROJECTS_YAML', '/home/gerrit2/projects.yaml')
 ZANATA_URL = os.environ.get('ZANATA_URL')
 ZANATA_USER = os.environ.get('ZANATA_USER')
 ZANATA_KEY = os.environ.get('ZANATA_KEY')
+WORKERS = 4
 
 log = logging.getLogger('register_zanata_projects')
 
 
+def load_registered(path):
+    """Return the set of projects recorded as registered in path."""
+    try:
+        with open(path) as state_file:
+            return set(json.load(state_file))
+    except (IOError, ValueError):
+        return set()
+
+
+def save_registered(path, registered):
+    try:
+        state_dir = os.path.dirname(path)
+        if not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+        u.write_if_changed(path, json.dumps(sorted(registered), indent=2))
+    except (IOError, OSError) as e:
+        # The projects are checked again on the next run
+        log.warning("Unable to save registered projects to %s: %s"
+                    % (path, e))
+
+
+def register_project(rest_service, project, known_projects):
+    """Register project and its master iteration, True on success."""
+    log.info("Processing project %s" % project)
+    (org, name) = project.split('/')
+    try:
+        translation_proect = t.TranslationProject(rest_service, name)
+        translation_proect.register(known_projects)
+    except ValueError as e:
+        log.error(e)
+        return False
+    return True
+
+
 def main():
     parser = argparse.ArgumentParser(description='Register projects in Zanata')
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help='The number of projects to register at once')
+    parser.add_argument('--verify', action='store_true',
+                        help='Check every project in Zanata, even those '
+                             'recorded as registered')
     l.setup_logging_arguments(parser)
     args = parser.parse_args()
     l.configure_logging(args)
 
     registry = u.ProjectsRegistry(PROJECTS_YAML)
-    rest_service = t.ZanataRestService(ZANATA_URL, ZANATA_USER, ZANATA_KEY)
     log.info("Registering projects in Zanata")
-    for entry in registry.configs_list:
-        project = entry['project']
-        if not p.has_translations(project):
-            continue
-        log.info("Processing project %s" % project)
-        (org, name) = project.split('/')
-        try:
-            translation_proect = t.TranslationProject(rest_service, name)
-            translation_proect.register()
-        except ValueError as e:
-            log.error(e)
+    # Registration is a one time event, projects which were registered
+    # by an earlier run are not checked again unless asked to.
+    state_path = p.cache_path('zanata_registered.json')
+    registered = set()
+    if not args.verify:
+        registered = load_registered(state_path)
+    projects = [entry['project'] for entry in registry.configs_list
+                if p.has_translations(entry['project']) and
+                entry['project'] not in registered]
+    if not projects:
+        log.info("All projects are already registered")
+        return
+
+    rest_service = t.ZanataRestService(ZANATA_URL, ZANATA_USER, ZANATA_KEY,
+                                       pool_size=args.workers)
+    try:
+        known_projects = rest_service.list_projects()
+    except ValueError as e:
+        # Fall back to probing for each project
+        log.warning(e)
+        known_projects = None
+
+    workers = pool.ThreadPool(args.workers)
+    try:
+        results = workers.map(
+            lambda project: register_project(rest_service, project,
+                                             known_projects),
+            projects)
+    finally:
+        workers.close()
+        workers.join()
+
+    registered.update(project for (project, ok) in zip(projects, results)
+                      if ok)
+    save_registered(state_path, registered)
 
 
 if __name__ == "__main__":
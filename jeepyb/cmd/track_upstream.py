@@ -53,10 +53,9 @@
 import argparse
 import json
 import logging
+from multiprocessing import pool
 import os
 
-import gerritlib.gerrit
-
 import jeepyb.log as l
 import jeepyb.utils as u
 
@@ -65,79 +64,100 @@ registry = u.ProjectsRegistry()
 log = logging.getLogger("track_upstream")
 orgs = None
 
+# The refs last pushed to Gerrit, kept inside each mirror
+PUSHED_REFS = 'jeepyb-pushed-refs'
 
-def update_local_copy(repo_path, track_upstream, git_opts, ssh_env):
-    # first do a clean of the branch to prevent possible
-    # problems due to previous runs
-    u.git_command(repo_path, "clean -fdx")
-
-    has_upstream_remote = (
-        'upstream' in u.git_command_output(repo_path, 'remote')[1])
-    if track_upstream:
-        # If we're configured to track upstream but the repo
-        # does not have an upstream remote, add one
-        if not has_upstream_remote:
-            u.git_command(
-                repo_path,
-                "remote add upstream %(upstream)s" % git_opts)
-
-        # If we're configured to track upstream, make sure that
-        # the upstream URL matches the config
-        else:
-            u.git_command(
-                repo_path,
-                "remote set-url upstream %(upstream)s" % git_opts)
-
-        # Now that we have any upstreams configured, fetch all of the refs
-        # we might need, pruning remote branches that no longer exist
-        u.git_command(
-            repo_path, "remote update --prune", env=ssh_env)
-    else:
-        # If we are not tracking upstream, then we do not need
-        # an upstream remote configured
-        if has_upstream_remote:
-            u.git_command(repo_path, "remote rm upstream")
-
-    # TODO(mordred): This is here so that later we can
-    # inspect the master branch for meta-info
-    # Checkout master and reset to the state of origin/master
-    u.git_command(repo_path, "checkout -B master origin/master")
-
-
-def sync_upstream(repo_path, project, ssh_env, upstream_prefix):
-    u.git_command(
-        repo_path,
-        "remote update upstream --prune", env=ssh_env)
-    # Any branch that exists in the upstream remote, we want
-    # a local branch of, optionally prefixed with the
-    # upstream prefix value
-    for branch in u.git_command_output(
-            repo_path, "branch -a")[1].split('\n'):
-        if not branch.strip().startswith("remotes/upstream"):
-            continue
-        if "->" in branch:
-            continue
-        local_branch = branch.split()[0][len('remotes/upstream/'):]
-        if upstream_prefix:
-            local_branch = "%s/%s" % (
-                upstream_prefix, local_branch)
 
-        # Check out an up to date copy of the branch, so that
-        # we can push it and it will get picked up below
-        u.git_command(
-            repo_path, "checkout -B %s %s" % (local_branch, branch))
+def mirror_git(mirror_path, sub_cmd, env=None):
+    return u.run_command_status(
+        "git --git-dir=%s %s" % (mirror_path, sub_cmd), env=env or {})
+
 
+def mirror_config(upstream, remote_url, upstream_prefix):
+    """Return the (key, value) config wanted in a project's mirror."""
+    if upstream_prefix:
+        heads = '+refs/heads/*:refs/heads/%s/*' % upstream_prefix
+    else:
+        heads = '+refs/heads/*:refs/heads/*'
+    return [
+        ('remote.upstream.url', upstream),
+        ('remote.upstream.fetch', heads),
+        ('remote.upstream.fetch', '+refs/tags/*:refs/tags/*'),
+        ('remote.origin.url', remote_url),
+        # Check what is fetched instead of running fsck on every sync.
+        # Gerrit/jgit does not accept zeroPaddedFilemode, C git does.
+        ('fetch.fsckobjects', 'true'),
+        ('fetch.fsck.zeropaddedfilemode', 'error'),
+    ]
+
+
+def ensure_mirror(mirror_path, upstream, remote_url, upstream_prefix):
+    """Create the bare mirror of a project, or bring its config up to date.
+
+    Upstream branches are fetched straight to their (prefixed) names, so
+    no working tree or local branches are needed.
+    """
+    if not os.path.exists(mirror_path):
+        status, out = u.run_command_status("git init --bare %s" % mirror_path)
+        if status != 0:
+            raise Exception("git init of %s failed:\n%s" % (mirror_path, out))
+    wanted = mirror_config(upstream, remote_url, upstream_prefix)
+    status, out = mirror_git(mirror_path,
+                             "config --get-regexp '^(remote|fetch)\\.'")
+    current = [tuple(line.split(' ', 1)) for line in out.splitlines()
+               if line]
+    if sorted(current) == sorted(wanted):
+        return
+    for key in sorted(set(key for (key, value) in wanted)):
+        mirror_git(mirror_path, "config --unset-all %s" % key)
+    for (key, value) in wanted:
+        mirror_git(mirror_path, "config --add %s %s" % (key, value))
+
+
+def sync_mirror(mirror_path, project, ssh_env):
+    """Fetch upstream into the mirror and push any new refs to Gerrit.
+
+    Returns True if anything was pushed.
+    """
+    status, out = mirror_git(mirror_path, "fetch --prune upstream",
+                             env=ssh_env)
+    if status != 0:
+        raise Exception("Fetching upstream of %s failed:\n%s"
+                        % (project, out))
+    status, refs = mirror_git(
+        mirror_path, "for-each-ref --format='%(objectname) %(refname)'")
+    pushed_path = os.path.join(mirror_path, PUSHED_REFS)
+    try:
+        with open(pushed_path) as pushed_file:
+            pushed = pushed_file.read()
+    except IOError:
+        pushed = None
+    if refs == pushed:
+        log.info("%s is up to date" % project)
+        return False
+
+    # Push all of the branches to similarly named branches on
+    # gerrit. Also, push all of the tags
+    for push in ("push origin refs/heads/*:refs/heads/*",
+                 "push origin --tags"):
+        status, out = mirror_git(mirror_path, push, env=ssh_env)
+        if status != 0:
+            log.error("Error pushing %s to Gerrit:\n%s" % (project, out))
+            return False
+    u.write_if_changed(pushed_path, refs)
+    return True
+
+
+def process_project(project, mirror_path, upstream, remote_url,
+                    upstream_prefix, ssh_env):
     try:
-        # Push all of the local branches to similarly named
-        # Branches on gerrit. Also, push all of the tags
-        u.git_command(
-            repo_path,
-            "push origin refs/heads/*:refs/heads/*",
-            env=ssh_env)
-        u.git_command(repo_path, 'push origin --tags', env=ssh_env)
+        log.info("Processing project: %s" % project)
+        ensure_mirror(mirror_path, upstream, remote_url, upstream_prefix)
+        return sync_mirror(mirror_path, project, ssh_env)
     except Exception:
         log.exception(
-            "Error pushing %s to Gerrit." % project)
+            "Problems creating %s, moving on." % project)
+        return False
 
 
 def main():
@@ -145,6 +165,8 @@ def main():
     l.setup_logging_arguments(parser)
     parser.add_argument('--nocleanup', action='store_true',
                         help='do not remove temp directories')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of projects to sync at once')
     parser.add_argument('projects', metavar='project', nargs='*',
                         help='name of project(s) to process')
     args = parser.parse_args()
@@ -157,73 +179,50 @@ def main():
     GERRIT_PORT = int(registry.get_defaults('gerrit-port', '29418'))
     GERRIT_USER = registry.get_defaults('gerrit-user')
     GERRIT_KEY = registry.get_defaults('gerrit-key')
-    GERRIT_GITID = registry.get_defaults('gerrit-committer')
 
     PROJECT_CACHE_FILE = os.path.join(JEEPYB_CACHE_DIR, 'project.cache')
     project_cache = {}
     if os.path.exists(PROJECT_CACHE_FILE):
         project_cache = json.loads(open(PROJECT_CACHE_FILE, 'r').read())
 
-    gerrit = gerritlib.gerrit.Gerrit(GERRIT_HOST,
-                                     GERRIT_USER,
-                                     GERRIT_PORT,
-                                     GERRIT_KEY)
-    project_list = gerrit.listProjects()
+    work = []
+    for section in registry.configs_list:
+        project = section['project']
+        if args.projects and project not in args.projects:
+            continue
+
+        # Figure out all of the options
+        options = section.get('options', dict())
+        track_upstream = 'track-upstream' in options
+        if not track_upstream:
+            continue
+
+        # If this project doesn't want to use gerrit, exit cleanly.
+        if 'no-gerrit' in options:
+            continue
+
+        if not project_cache.get(project, {}).get('pushed-to-gerrit'):
+            continue
+
+        # Bare mirrors live next to the import working copies
+        mirror_path = os.path.join(IMPORT_DIR, "%s.git" % project)
+        remote_url = "ssh://%s:%s/%s" % (
+            GERRIT_HOST,
+            GERRIT_PORT,
+            project)
+        work.append((project, mirror_path, section.get('upstream', None),
+                     remote_url, section.get('upstream-prefix', None)))
+
     ssh_env = u.make_ssh_wrapper(GERRIT_USER, GERRIT_KEY)
+    workers = pool.ThreadPool(args.workers)
     try:
-
-        for section in registry.configs_list:
-            project = section['project']
-            if args.projects and project not in args.projects:
-                continue
-
-            try:
-                log.info("Processing project: %s" % project)
-
-                # Figure out all of the options
-                options = section.get('options', dict())
-                track_upstream = 'track-upstream' in options
-                if not track_upstream:
-                    continue
-
-                # If this project doesn't want to use gerrit, exit cleanly.
-                if 'no-gerrit' in options:
-                    continue
-
-                upstream = section.get('upstream', None)
-                upstream_prefix = section.get('upstream-prefix', None)
-                repo_path = os.path.join(IMPORT_DIR, project)
-
-                project_git = "%s.git" % project
-                remote_url = "ssh://%s:%s/%s" % (
-                    GERRIT_HOST,
-                    GERRIT_PORT,
-                    project)
-                git_opts = dict(upstream=upstream,
-                                repo_path=repo_path,
-                                remote_url=remote_url)
-                project_cache.setdefault(project, {})
-                if not project_cache[project]['pushed-to-gerrit']:
-                    continue
-
-                # Make Local repo
-                if not os.path.exists(repo_path):
-                    u.make_local_copy(
-                        repo_path, project, project_list,
-                        git_opts, ssh_env, upstream, GERRIT_HOST,
-                        GERRIT_PORT, project_git, GERRIT_GITID)
-                else:
-                    update_local_copy(
-                        repo_path, track_upstream, git_opts, ssh_env)
-
-                u.fsck_repo(repo_path)
-                sync_upstream(repo_path, project, ssh_env, upstream_prefix)
-
-            except Exception:
-                log.exception(
-                    "Problems creating %s, moving on." % project)
-                continue
+        results = workers.map(
+            lambda item: process_project(*(item + (ssh_env,))), work)
+        log.info("Synced %d projects, pushed %d"
+                 % (len(work), sum(1 for pushed in results if pushed)))
     finally:
+        workers.close()
+        workers.join()
         os.unlink(ssh_env['GIT_SSH'])
 
 if __name__ == "__main__":
@@ -36,10 +36,25 @@
 
 from __future__ import print_function
 
+import hashlib
 import json
 import optparse
+import os
+import re
 import subprocess
 import sys
+import tempfile
+import time
+
+import jeepyb.gerrit_ssh as gerrit_ssh
+import jeepyb.gerritdb
+
+PATCH_ID_CACHE_SIZE = 1000
+# Bumped whenever _PatchIds changes, so stale cached ids are not used
+PATCH_ID_VERSION = 4
+SHA_RE = re.compile(r'^[0-9a-f]{40}$')
+# Added or removed lines, as opposed to the ---/+++ file headers
+WS_CHANGE_RE = re.compile(r'^(\+[^+]|-[^-])')
 
 
 class SilentOptionParser(optparse.OptionParser):
@@ -54,7 +69,7 @@ class SilentOptionParser(optparse.OptionParser):
 
 
 class CheckCallError(OSError):
-    """CheckCall() returned non-0."""
+    """A git or Gerrit command returned non-0."""
     def __init__(self, command, cwd, retcode, stdout, stderr=None):
         OSError.__init__(self, command, cwd, retcode, stdout, stderr)
         self.command = command
@@ -64,117 +79,256 @@ class CheckCallError(OSError):
         self.stderr = stderr
 
 
-def CheckCall(command, cwd=None):
-    """Like subprocess.check_call() but returns stdout.
+def GetPrevPatchSet(options):
+    """Finds the revision and approvals of the previous patch set.
 
-    Works on python 2.4
+    Returns a (revision, approvals) tuple, where approvals is a list of
+    approval dicts. The revision is None if there is no previous patch
+    set.
     """
-    try:
-        process = subprocess.Popen(command, cwd=cwd, stdout=subprocess.PIPE)
-        std_out, std_err = process.communicate()
-    except OSError as e:
-        raise CheckCallError(command, cwd, e.errno, None)
-    if process.returncode:
-        raise CheckCallError(command, cwd, process.returncode,
-                             std_out, std_err)
-    return std_out, std_err
-
-
-def Gssh(options, api_command):
-    """Makes a Gerrit API call via SSH and returns the stdout results."""
-    ssh_cmd = ['ssh',
-               '-l', 'Gerrit Code Review',
-               '-p', options.port,
-               '-i', options.private_key_path,
-               options.server,
-               api_command]
-    try:
-        return CheckCall(ssh_cmd)[0]
-    except CheckCallError as e:
-        err_template = "call: %s\nreturn code: %s\nstdout: %s\nstderr: %s\n"
-        sys.stderr.write(err_template % (ssh_cmd,
-                                         e.retcode,
-                                         e.stdout,
-                                         e.stderr))
-        raise
+    rows = jeepyb.gerritdb.get_patch_set_approvals(options.changeId,
+                                                   options.patchset - 1)
+    if not rows:
+        return None, []
+    approvals = []
+    for revision, value, account_id, category_id in rows:
+        if category_id is None:
+            # No approvals, only the patch set row from the outer join
+            continue
+        approvals.append({"value": str(value),
+                          "account_id": str(account_id),
+                          "category_id": category_id.strip()})
+    return rows[0][0], approvals
+
+
+def _ScanHunkHeader(line):
+    """Returns the (before, after) line counts of a '@@ -a,b +c,d @@' line."""
+    ranges = line.split('@@')[1].split()
+    counts = []
+    for r in ranges[:2]:
+        if ',' in r:
+            counts.append(int(r.split(',')[1]))
+        else:
+            counts.append(1)
+    return tuple(counts)
+
 
+def _RemoveSpace(line):
+    # Like git's remove_space(), which only drops these; str.split()
+    # would also drop e.g. form feeds
+    return ''.join(c for c in line if c not in ' \t\n\r')
 
-def GsqlQuery(sql_query, options):
-    """Runs a gerrit gsql query and returns the result."""
-    gsql_cmd = "gerrit gsql --format JSON -c %s" % sql_query
-    gsql_out = Gssh(options, gsql_cmd)
-    new_out = gsql_out.replace('}}\n', '}}\nsplit here\n')
-    return new_out.split('split here\n')
 
+def _PatchIds(diff_lines):
+    """Computes the patch-ids of a single commit's diff.
 
-def FindPrevRev(options):
-    """Finds the revision of the previous patch set on the change."""
-    sql_query = ("\"SELECT revision FROM patch_sets,changes WHERE "
-                 "patch_sets.change_id = changes.change_id AND "
-                 "patch_sets.patch_set_id = %s AND "
-                 "changes.change_key = \'%s\'\"" % ((options.patchset - 1),
-                                                    options.changeId))
-    revisions = GsqlQuery(sql_query, options)
+    This follows what git patch-id does: hash the diff with all
+    whitespace and hunk line numbers removed. The second id is
+    computed as if space and tab characters on added and removed lines
+    were significant.
 
-    json_dict = json.loads(revisions[0], strict=False)
-    return json_dict["columns"]["revision"]
+    Returns (patch_id, whitespace_patch_id), or (None, None) if the
+    commit has an empty diff.
+    """
+    ctx = hashlib.sha1()
+    ws_ctx = hashlib.sha1()
+    patchlen = 0
+    before = after = -1
+    for line in diff_lines:
+        # Ignore anything ahead of the diff
+        if not patchlen and not line.startswith('diff '):
+            continue
+
+        # "\ No newline at end of file" is not part of any hunk
+        if line.startswith('\\ '):
+            continue
+
+        # Parsing diff header?
+        if before == -1:
+            if line.startswith('index '):
+                continue
+            elif line.startswith('--- '):
+                before = after = 1
+            elif not line[:1].isalpha():
+                break
+
+        # Looking for a valid hunk header?
+        if before == 0 and after == 0:
+            if line.startswith('@@ -'):
+                # Parse next hunk, but ignore line numbers
+                before, after = _ScanHunkHeader(line)
+                continue
+            # Split at the end of the patch
+            if not line.startswith('diff '):
+                break
+            # Else we're parsing another header
+            before = after = -1
+
+        # If we get here, we're inside a hunk
+        if line[:1] in ('-', ' '):
+            before -= 1
+        if line[:1] in ('+', ' '):
+            after -= 1
+
+        stripped = _RemoveSpace(line)
+        patchlen += len(stripped)
+        ctx.update(stripped)
+        if WS_CHANGE_RE.match(line):
+            ws_ctx.update(
+                _RemoveSpace(line.replace(' ', '%').replace('\t', '%')))
+        else:
+            ws_ctx.update(stripped)
+    if not patchlen:
+        return None, None
+    return ctx.hexdigest(), ws_ctx.hexdigest()
 
 
-def GetApprovals(options):
-    """Get all the approvals on a specific patch set.
+class PatchIdCache(object):
+    """Patch-ids by revision, optionally persisted to a JSON file.
 
-    Returns a list of approval dicts
+    Each run computes the ids of the new patchset, so keeping them
+    means the previous patchset's ids never have to be computed again.
     """
-    sql_query = ("\"SELECT value,account_id,category_id"
-                 " FROM patch_set_approvals"
-                 " WHERE patch_set_id = %s"
-                 " AND change_id = (SELECT change_id FROM"
-                 " changes WHERE change_key = \'%s\') AND value <> 0\""
-                 % ((options.patchset - 1), options.changeId))
-    gsql_out = GsqlQuery(sql_query, options)
-    approvals = []
-    for json_str in gsql_out:
-        dict = json.loads(json_str, strict=False)
-        if dict["type"] == "row":
-            approvals.append(dict["columns"])
-    return approvals
-
-
-def GetPatchId(revision, consider_whitespace=False):
-    git_show_cmd = ['git', 'show', revision]
-    patch_id_cmd = ['git', 'patch-id']
-    patch_id_process = subprocess.Popen(patch_id_cmd, stdout=subprocess.PIPE,
-                                        stdin=subprocess.PIPE)
-    git_show_process = subprocess.Popen(git_show_cmd, stdout=subprocess.PIPE)
-    if consider_whitespace:
-        # This matches on change lines in the patch (those starting with "+"
-        # or "-" but not followed by another of the same), then replaces any
-        # space or tab characters with "%" before calculating a patch-id.
-        replace_ws_cmd = ['sed', r'/^\(+[^+]\|-[^-]\)/y/ \t/%%/']
-        replace_ws_process = subprocess.Popen(replace_ws_cmd,
-                                              stdout=subprocess.PIPE,
-                                              stdin=subprocess.PIPE)
-        git_show_output = git_show_process.communicate()[0]
-        replace_ws_output = replace_ws_process.communicate(git_show_output)[0]
-        return patch_id_process.communicate(replace_ws_output)[0]
-    else:
-        return patch_id_process.communicate(
-            git_show_process.communicate()[0])[0]
-
-
-def SuExec(options, as_user, cmd):
-    suexec_cmd = "suexec --as %s -- %s" % (as_user, cmd)
-    Gssh(options, suexec_cmd)
-
-
-def DiffCommitMessages(commit1, commit2):
-    log_cmd1 = ['git', 'log', '--pretty=format:"%an %ae%n%s%n%b"',
-                commit1 + '^!']
-    commit1_log = CheckCall(log_cmd1)
-    log_cmd2 = ['git', 'log', '--pretty=format:"%an %ae%n%s%n%b"',
-                commit2 + '^!']
-    commit2_log = CheckCall(log_cmd2)
-    if commit1_log != commit2_log:
+    def __init__(self, path=None):
+        self.path = path
+        self.ids = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r') as cache_file:
+                    self.ids = json.load(cache_file)
+            except (IOError, ValueError):
+                self.ids = {}
+
+    def get(self, revision):
+        entry = self.ids.get(revision)
+        if entry and entry[3:] == [PATCH_ID_VERSION]:
+            return entry[0], entry[1]
+        return None
+
+    def set(self, revision, patch_ids):
+        if SHA_RE.match(revision):
+            self.ids[revision] = [patch_ids[0], patch_ids[1], time.time(),
+                                  PATCH_ID_VERSION]
+
+    def save(self):
+        if not self.path:
+            return
+        if len(self.ids) > PATCH_ID_CACHE_SIZE:
+            newest = sorted(self.ids.items(), key=lambda item: item[1][2])
+            self.ids = dict(newest[-PATCH_ID_CACHE_SIZE:])
+        try:
+            (fd, tmp_path) = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(self.path)))
+            with os.fdopen(fd, 'w') as cache_file:
+                json.dump(self.ids, cache_file)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            sys.stderr.write("Unable to save patch-id cache: %s\n" % e)
+
+
+class CommitReader(object):
+    """Reads commit metadata and diffs, one git process per batch.
+
+    The metadata of a commit is its author, subject and body, and is
+    recorded for every commit read, so comparing commit messages after
+    the patch-ids needs no further git calls.
+    """
+    # Every commit starts with a NUL separated header, so the output
+    # splits into (header, diff) records in order.
+    FORMAT = '--format=%x00%H%n%an %ae%n%s%n%b%x00'
+
+    def __init__(self):
+        self.metadata = {}
+
+    def Read(self, revisions, patch=True):
+        """Reads the revisions, returning a dict of their diff lines."""
+        # --always outputs the header even when the diff is empty.
+        diff_cmd = ['git', 'diff-tree', '--root', '--always', '--stdin',
+                    self.FORMAT, '-p' if patch else '-s']
+        process = subprocess.Popen(diff_cmd, stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE)
+        output = process.communicate(
+            ''.join(r + '\n' for r in revisions))[0]
+        if process.returncode:
+            raise CheckCallError(diff_cmd, None, process.returncode, output)
+
+        records = output.split('\0')[1:]
+        diffs = {}
+        for revision, header, diff in zip(revisions, records[0::2],
+                                          records[1::2]):
+            self.metadata[revision] = header.split('\n', 1)[1]
+            # Only newlines end lines, a \r can be part of a diff line
+            diffs[revision] = diff.split('\n')
+        return diffs
+
+
+def GetPatchIds(revisions, cache, reader):
+    """Gets (patch_id, whitespace_patch_id) for each of the revisions.
+
+    All the revisions missing from the cache are read in a single batch.
+    Returns a dict keyed by revision.
+    """
+    result = {}
+    missing = []
+    for revision in revisions:
+        cached = cache.get(revision)
+        if cached:
+            result[revision] = cached
+        else:
+            missing.append(revision)
+    if not missing:
+        return result
+
+    diffs = reader.Read(missing)
+    for revision in missing:
+        result[revision] = _PatchIds(diffs.get(revision, []))
+        cache.set(revision, result[revision])
+    return result
+
+
+class GerritSession(object):
+    """Runs suexec commands over a single SSH connection to Gerrit.
+
+    Every command gets its own channel on the connection, so several
+    commands can run at once.
+    """
+    def __init__(self, options):
+        self.ssh = gerrit_ssh.get_connection(
+            options.server, username='Gerrit Code Review',
+            key_filename=options.private_key_path, port=options.port)
+
+    def SuExecMany(self, commands):
+        """Runs (as_user, cmd) commands concurrently and waits for them."""
+        running = []
+        for as_user, cmd in commands:
+            suexec_cmd = "suexec --as %s -- %s" % (as_user, cmd)
+            stdin, stdout, stderr = self.ssh.exec_command(suexec_cmd)
+            running.append((suexec_cmd, stdout, stderr))
+        failed = 0
+        for suexec_cmd, stdout, stderr in running:
+            std_out = stdout.read()
+            retcode = stdout.channel.recv_exit_status()
+            if retcode:
+                err_template = "call: %s\nreturn code: %s\nstdout: %s\n" \
+                               "stderr: %s\n"
+                sys.stderr.write(err_template % (suexec_cmd, retcode,
+                                                 std_out, stderr.read()))
+                failed = retcode
+        if failed:
+            raise CheckCallError(commands, None, failed, None)
+
+    def SuExec(self, as_user, cmd):
+        self.SuExecMany([(as_user, cmd)])
+
+    def Close(self):
+        self.ssh.close()
+
+
+def DiffCommitMessages(reader, commit1, commit2):
+    missing = [c for c in (commit1, commit2) if c not in reader.metadata]
+    if missing:
+        reader.Read(missing, patch=False)
+    if reader.metadata[commit1] != reader.metadata[commit2]:
         return True
     return False
 
@@ -198,6 +352,8 @@ def main():
                            "[default: %default]")
     parser.add_option("--whitespace", action="store_true",
                       help="Treat whitespace as significant")
+    parser.add_option("--patch-id-cache", dest="patch_id_cache",
+                      help="File to keep computed patch-ids in between runs")
 
     (options, args) = parser.parse_args()
 
@@ -208,37 +364,50 @@ def main():
     if options.patchset == 1:
         # Nothing to detect on first patchset
         sys.exit(0)
-    prev_revision = None
-    prev_revision = FindPrevRev(options)
+    prev_revision, approvals = GetPrevPatchSet(options)
     if not prev_revision:
         # Couldn't find a previous revision
         sys.exit(0)
-    prev_patch_id = GetPatchId(prev_revision)
-    cur_patch_id = GetPatchId(options.commit)
-    if cur_patch_id.split()[0] != prev_patch_id.split()[0]:
+    patch_id_cache = PatchIdCache(options.patch_id_cache)
+    reader = CommitReader()
+    patch_ids = GetPatchIds([prev_revision, options.commit], patch_id_cache,
+                            reader)
+    patch_id_cache.save()
+    prev_patch_id, prev_patch_ws = patch_ids[prev_revision]
+    cur_patch_id, cur_patch_ws = patch_ids[options.commit]
+    if cur_patch_id is None or cur_patch_id != prev_patch_id:
         # patch-ids don't match
         sys.exit(0)
     # Patch ids match. This is a trivial rebase.
+    session = GerritSession(options)
+    try:
+        ReapplyApprovals(options, session, reader, prev_revision, approvals,
+                         prev_patch_ws, cur_patch_ws)
+    finally:
+        session.Close()
+    sys.exit(0)
+
+
+def ReapplyApprovals(options, session, reader, prev_revision, approvals,
+                     prev_patch_ws, cur_patch_ws):
     # In addition to patch-id we should check if whitespace content changed.
     # Some languages are more sensitive to whitespace than others, and some
     # changes may either introduce or be intended to fix style problems
     # specifically involving whitespace as well.
     if options.whitespace:
-        prev_patch_ws = GetPatchId(prev_revision, consider_whitespace=True)
-        cur_patch_ws = GetPatchId(options.commit, consider_whitespace=True)
-        if cur_patch_ws.split()[0] != prev_patch_ws.split()[0]:
+        if cur_patch_ws != prev_patch_ws:
             # Insert a comment into the change letting the approvers know
             # only the whitespace changed
             comment_msg = ("\"New patchset patch-id matches previous patchset,"
                            " but whitespace content has changed.\"")
             comment_cmd = ['gerrit', 'approve', '--project', options.project,
                            '--message', comment_msg, options.commit]
-            SuExec(options, options.role_user, ' '.join(comment_cmd))
-            sys.exit(0)
+            session.SuExec(options.role_user, ' '.join(comment_cmd))
+            return
 
     # We should also check if the commit message changed. Most approvers would
     # want to re-review changes when the commit message changes.
-    changed = DiffCommitMessages(prev_revision, options.commit)
+    changed = DiffCommitMessages(reader, prev_revision, options.commit)
     if changed:
         # Insert a comment into the change letting the approvers know only the
         # commit message changed
@@ -246,14 +415,15 @@ def main():
                        " but commit message has changed.\"")
         comment_cmd = ['gerrit', 'approve', '--project', options.project,
                        '--message', comment_msg, options.commit]
-        SuExec(options, options.role_user, ' '.join(comment_cmd))
-        sys.exit(0)
+        session.SuExec(options.role_user, ' '.join(comment_cmd))
+        return
 
-    # Need to get all approvals on prior patch set, then suexec them onto
-    # this patchset.
-    approvals = GetApprovals(options)
+    # Need to suexec all approvals on prior patch set onto this patchset,
+    # with a single approve command per account.
     gerrit_approve_msg = ("\'Automatically re-added by Gerrit trivial rebase "
                           "detection script.\'")
+    account_scores = {}
+    accounts = []
     for approval in approvals:
         # Note: Sites with different 'copy_min_score' values in the
         # approval_categories DB table might want different behavior here.
@@ -271,16 +441,28 @@ def main():
             # Similarly squash old approvals
             continue
         else:
+            # Stop here, but still re-add the approvals found so far
             print("Unsupported category: %s" % approval)
-            sys.exit(0)
-
-        score = approval["value"]
-        gerrit_approve_cmd = ['gerrit', 'approve',
-                              '--project', options.project,
-                              '--message', gerrit_approve_msg,
-                              approve_category, score, options.commit]
-        SuExec(options, approval["account_id"], ' '.join(gerrit_approve_cmd))
-    sys.exit(0)
+            break
+
+        account_id = approval["account_id"]
+        if account_id not in account_scores:
+            account_scores[account_id] = []
+            accounts.append(account_id)
+        account_scores[account_id].extend((approve_category,
+                                           approval["value"]))
+
+    commands = []
+    for account_id in accounts:
+        gerrit_approve_cmd = (['gerrit', 'approve',
+                               '--project', options.project,
+                               '--message', gerrit_approve_msg] +
+                              account_scores[account_id] +
+                              [options.commit])
+        commands.append((account_id, ' '.join(gerrit_approve_cmd)))
+    if commands:
+        session.SuExecMany(commands)
+
 
 if __name__ == "__main__":
     main()
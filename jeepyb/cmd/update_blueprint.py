@@ -18,53 +18,23 @@
 # corresponding Launchpad blueprints with links back to the change.
 
 import argparse
-import ConfigParser
 import os
-import re
-import StringIO
-import subprocess
 
 from launchpadlib import launchpad
 from launchpadlib import uris
-import pymysql
 
+from jeepyb import commitmsg
+from jeepyb import gerritdb
+from jeepyb import gitlog
 from jeepyb import projects as p
 
 
-BASE_DIR = '/home/gerrit2/review_site'
 GERRIT_CACHE_DIR = os.path.expanduser(
     os.environ.get('GERRIT_CACHE_DIR',
                    '~/.launchpadlib/cache'))
 GERRIT_CREDENTIALS = os.path.expanduser(
     os.environ.get('GERRIT_CREDENTIALS',
                    '~/.launchpadlib/creds'))
-GERRIT_CONFIG = os.environ.get('GERRIT_CONFIG',
-                               '/home/gerrit2/review_site/etc/gerrit.config')
-GERRIT_SECURE_CONFIG_DEFAULT = '/home/gerrit2/review_site/etc/secure.config'
-GERRIT_SECURE_CONFIG = os.environ.get('GERRIT_SECURE_CONFIG',
-                                      GERRIT_SECURE_CONFIG_DEFAULT)
-SPEC_RE = re.compile(r'\b(blueprint|bp)\b[ \t]*[#:]?[ \t]*(\S+)', re.I)
-BODY_RE = re.compile(r'^\s+.*$')
-
-
-def get_broken_config(filename):
-    """gerrit config ini files are broken and have leading tabs."""
-    text = ""
-    with open(filename, "r") as conf:
-        for line in conf.readlines():
-            text = "%s%s" % (text, line.lstrip())
-
-    fp = StringIO.StringIO(text)
-    c = ConfigParser.ConfigParser()
-    c.readfp(fp)
-    return c
-
-GERRIT_CONFIG = get_broken_config(GERRIT_CONFIG)
-SECURE_CONFIG = get_broken_config(GERRIT_SECURE_CONFIG)
-DB_HOST = GERRIT_CONFIG.get("database", "hostname")
-DB_USER = GERRIT_CONFIG.get("database", "username")
-DB_PASS = SECURE_CONFIG.get("database", "password")
-DB_DB = GERRIT_CONFIG.get("database", "database")
 
 
 def update_spec(launchpad, project, name, subject, link, topic=None):
@@ -106,13 +76,9 @@ def update_spec(launchpad, project, name, subject, link, topic=None):
         spec.lp_save()
 
 
-def find_specs(launchpad, dbconn, args):
-    git_dir_arg = '--git-dir={base_dir}/git/{project}.git'.format(
-        base_dir=BASE_DIR,
-        project=args.project)
-    git_log = subprocess.Popen(['git', git_dir_arg, 'log', '--no-merges',
-                                args.commit + '^1..' + args.commit],
-                               stdout=subprocess.PIPE).communicate()[0]
+def find_specs(launchpad, args):
+    git_log = gitlog.extract_git_log(args.project, args.commit,
+                                     cache_dir=p.cache_path('gitlog'))
 
     change = args.change
     if '~' in change:
@@ -120,11 +86,11 @@ def find_specs(launchpad, dbconn, args):
         # gtest-org%2Fgtest~master~I117f34aaa4253e0b82b98de9077f7188d55c3f33
         # So we need to split off the changeid if there is other data in there.
         change = change.rsplit('~', 1)[1]
-    cur = dbconn.cursor()
-    cur.execute("select subject, topic from changes where change_key=%s",
-                change)
-    subject, topic = cur.fetchone()
-    specs = set([m.group(2) for m in SPEC_RE.finditer(git_log)])
+    change_info = gerritdb.get_change(change)
+    if not change_info:
+        return
+    subject, topic = change_info
+    specs = set(commitmsg.parse(git_log).blueprints)
 
     if topic:
         topicspec = topic.split('/')[-1]
@@ -164,10 +130,7 @@ def main():
         'Gerrit User Sync', uris.LPNET_SERVICE_ROOT, GERRIT_CACHE_DIR,
         credentials_file=GERRIT_CREDENTIALS, version='devel')
 
-    conn = pymysql.connect(
-        host=DB_HOST, user=DB_USER, password=DB_PASS, db=DB_DB)
-
-    find_specs(lpconn, conn, args)
+    find_specs(lpconn, args)
 
 if __name__ == "__main__":
     main()
@@ -19,18 +19,17 @@
 
 import argparse
 import os
-import re
-import subprocess
 
 from launchpadlib import launchpad
 from launchpadlib import uris
 
+from jeepyb import commitmsg
 import jeepyb.gerritdb
+from jeepyb import gitlog
 from jeepyb import projects as p
 from jeepyb import utils as u
 
 
-BASE_DIR = '/home/gerrit2/review_site'
 GERRIT_CACHE_DIR = os.path.expanduser(
     os.environ.get('GERRIT_CACHE_DIR',
                    '~/.launchpadlib/cache'))
@@ -92,39 +91,10 @@ def set_in_progress(bugtask, launchpad, uploader, change_url):
     except ValueError:
         searchkey = uploader
 
-    # The counterintuitive query is due to odd database schema choices
-    # in Gerrit. For example, an account with a secondary E-mail
-    # address added looks like...
-    # select email_address,external_id from account_external_ids
-    #     where account_id=1234;
-    # +-----------------+-----------------------------------------+
-    # | email_address   | external_id                             |
-    # +-----------------+-----------------------------------------+
-    # | plugh@xyzzy.com | https://login.ubuntu.com/+id/fR0bnU1 |
-    # | bar@foo.org     | mailto:bar@foo.org                      |
-    # | NULL            | username:quux                           |
-    # +-----------------+-----------------------------------------+
-    # ...thus we need a join on a secondary query to search against
-    # all the user's configured E-mail addresses.
-    #
-    # Worse, we also need to filter by active accounts only since
-    # picking an inactive account could result in using the wrong
-    # OpenId entirely.
-    #
-    query = """SELECT t.external_id FROM account_external_ids t
-            INNER JOIN (
-                SELECT t.account_id FROM account_external_ids t
-                WHERE t.email_address = %s )
-            original ON t.account_id = original.account_id
-            AND t.external_id LIKE 'https://login.ubuntu.com%%'
-            JOIN accounts a ON a.account_id = t.account_id
-            WHERE a.inactive = 'N'"""
-
-    cursor = jeepyb.gerritdb.connect().cursor()
-    cursor.execute(query, searchkey)
-    data = cursor.fetchone()
-    if data:
-        assignee = launchpad.people.getByOpenIDIdentifier(identifier=data[0])
+    # See jeepyb.gerritdb.QUERIES for how the OpenID is found.
+    openid = jeepyb.gerritdb.get_openid(searchkey)
+    if openid:
+        assignee = launchpad.people.getByOpenIDIdentifier(identifier=openid)
         if assignee:
             bugtask.assignee = assignee
 
@@ -281,18 +251,7 @@ def process_bugtask(launchpad, task, git_log, args):
 def find_bugs(launchpad, git_log, args):
     '''Find bugs referenced in the git log and return related tasks.
 
-    Our regular expression is composed of three major parts:
-    part1: Matches only at start-of-line (required). Optionally matches any
-           word or hyphen separated words.
-    part2: Matches the words 'bug' or 'lp' on a word boundary (required).
-    part3: Matches a whole number (required).
-
-    The following patterns will be matched properly:
-    bug # 555555
-    Closes-Bug: 555555
-    Fixes: bug # 555555
-    Resolves: bug 555555
-    Partial-Bug: lp bug # 555555
+    See jeepyb.commitmsg.BUG_RE for the bug reference formats matched.
 
     :returns: an iterable containing Task objects.
     '''
@@ -304,17 +263,9 @@ def find_bugs(launchpad, git_log, args):
 
     projects = p.project_to_groups(project)
 
-    part1 = r'^[\t ]*(?P<prefix>[-\w]+)?[\s:]*'
-    part2 = r'(?:\b(?:bug|lp)\b[\s#:]*)+'
-    part3 = r'(?P<bug_number>\d+)\s*?$'
-    regexp = part1 + part2 + part3
-    matches = re.finditer(regexp, git_log, flags=re.I | re.M)
-
     # Extract unique bug tasks and associated prefixes.
     bugtasks = {}
-    for match in matches:
-        prefix = match.group('prefix')
-        bug_num = match.group('bug_number')
+    for prefix, bug_num in commitmsg.parse(git_log).bugs:
         if bug_num not in bugtasks:
             try:
                 lp_bug = launchpad.bugs[bug_num]
@@ -329,14 +280,6 @@ def find_bugs(launchpad, git_log, args):
     return bugtasks.values()
 
 
-def extract_git_log(args):
-    """Extract git log of all merged commits."""
-    cmd = ['git',
-           '--git-dir=' + BASE_DIR + '/git/' + args.project + '.git',
-           'log', '--no-merges', args.commit + '^1..' + args.commit]
-    return subprocess.Popen(cmd, stdout=subprocess.PIPE).communicate()[0]
-
-
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('hook')
@@ -368,7 +311,8 @@ def main():
         credentials_file=GERRIT_CREDENTIALS, version='devel')
 
     # Get git log.
-    git_log = extract_git_log(args)
+    git_log = gitlog.extract_git_log(args.project, args.commit,
+                                     cache_dir=p.cache_path('gitlog'))
 
     # Process tasks found in git log.
     for task in find_bugs(lpconn, git_log, args):
@@ -28,17 +28,58 @@
 
 import argparse
 import logging
-import paramiko
+import os
+import sqlite3
 
+import jeepyb.gerrit_ssh as gerrit_ssh
 import jeepyb.gerritdb
 import jeepyb.log as l
+import jeepyb.projects as p
 
 BASE_DIR = '/home/gerrit2/review_site'
 
 logger = logging.getLogger('welcome_reviews')
 
 
-def is_newbie(uploader):
+class KnownContributors(object):
+    """Persistent set of the emails of people who are not first-timers.
+
+    Once someone has uploaded more than one patchset they can never be a
+    first-timer again, so remembering them answers the question without
+    touching the Gerrit database.
+    """
+
+    def __init__(self, path):
+        self.db = None
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            self.db = sqlite3.connect(path)
+            self.db.execute('CREATE TABLE IF NOT EXISTS contributors '
+                            '(email TEXT PRIMARY KEY)')
+        except (OSError, sqlite3.Error):
+            logger.exception('Unable to open known contributors %s', path)
+            self.db = None
+
+    def __contains__(self, email):
+        if self.db is None:
+            return False
+        cursor = self.db.execute(
+            'SELECT 1 FROM contributors WHERE email = ?', (email,))
+        return cursor.fetchone() is not None
+
+    def add(self, email):
+        if self.db is None:
+            return
+        try:
+            with self.db:
+                self.db.execute(
+                    'INSERT OR IGNORE INTO contributors VALUES (?)', (email,))
+        except sqlite3.Error:
+            logger.exception('Unable to record known contributor')
+
+
+def is_newbie(uploader, known_contributors):
     """Determine if the owner of the patch is a first-timer."""
 
     # Retrieve uploader email
@@ -48,22 +89,17 @@ def is_newbie(uploader):
         logger.info('Couldnt get email for %s', uploader)
         return False
 
-    # this query looks for all distinct patchsets for the given
-    # user. If there's only 1, they're a first-timer.
-    query = """SELECT COUNT(DISTINCT p.change_id + p.patch_set_id)
-               FROM patch_sets p, account_external_ids a
-               WHERE a.email_address = %s
-               AND a.account_id = p.uploader_account_id;"""
-
-    cursor = jeepyb.gerritdb.connect().cursor()
-    cursor.execute(query, searchkey)
-    data = cursor.fetchone()
-    if data:
-        if data[0] == 1:
-            logger.info('We found a newbie: %s', uploader)
-            return True
-        else:
-            return False
+    if searchkey in known_contributors:
+        return False
+
+    # If the user has only 1 patchset, they're a first-timer.
+    data = jeepyb.gerritdb.get_patch_sets_by_email(searchkey)
+    if len(data) == 1:
+        logger.info('We found a newbie: %s', uploader)
+        return True
+    if len(data) > 1:
+        known_contributors.add(searchkey)
+    return False
 
 
 def post_message(commit, gerrit_user, gerrit_ssh_key, message_file):
@@ -111,14 +147,9 @@ def post_message(commit, gerrit_user, gerrit_ssh_key, message_file):
                    message=welcome_text,
                    commit=commit)
     logger.info('Welcoming: %s', commit)
-    ssh = paramiko.SSHClient()
-    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    ssh.connect('localhost', username=gerrit_user,
-                key_filename=gerrit_ssh_key, port=29418)
-    stdin, stdout, stderr = ssh.exec_command(command)
-    stdout_text = stdout.read()
-    stderr_text = stderr.read()
-    ssh.close()
+    ssh = gerrit_ssh.get_connection('localhost', username=gerrit_user,
+                                    key_filename=gerrit_ssh_key, port=29418)
+    status, stdout_text, stderr_text = ssh.run(command)
     if stdout_text:
         logger.debug('stdout: %s' % stdout_text)
     if stderr_text:
@@ -165,7 +196,11 @@ def main():
     l.configure_logging(args)
 
     # they're a first-timer, post the message on 1st patchset
-    if is_newbie(args.uploader) and args.patchset == '1' and not args.dryrun:
+    if args.patchset != '1':
+        return
+    known_contributors = KnownContributors(
+        p.cache_path('known_contributors.sqlite'))
+    if is_newbie(args.uploader, known_contributors) and not args.dryrun:
         post_message(args.commit, args.ssh_user, args.ssh_key,
                      args.message_file)
 
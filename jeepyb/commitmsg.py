@@ -0,0 +1,84 @@
+# Copyright (c) 2016 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Parse the output of git log into the fields the gerrit hooks act on.
+
+The hooks used to each run their own regular expressions over the same
+git log. Parsing it once here gives every hook the same view of the
+bug references, blueprints, impact flags, authors and Change-Ids.
+"""
+
+import re
+
+
+# Bug references are composed of three major parts:
+# part1: Matches only at start-of-line (required). Optionally matches any
+#        word or hyphen separated words.
+# part2: Matches the words 'bug' or 'lp' on a word boundary (required).
+# part3: Matches a whole number (required).
+#
+# The following patterns will be matched properly:
+# bug # 555555
+# Closes-Bug: 555555
+# Fixes: bug # 555555
+# Resolves: bug 555555
+# Partial-Bug: lp bug # 555555
+BUG_RE = re.compile(r'^[\t ]*(?P<prefix>[-\w]+)?[\s:]*'
+                    r'(?:\b(?:bug|lp)\b[\s#:]*)+'
+                    r'(?P<bug_number>\d+)\s*?$', re.I | re.M)
+SPEC_RE = re.compile(r'\b(blueprint|bp)\b[ \t]*[#:]?[ \t]*(\S+)', re.I)
+IMPACT_RE = re.compile(r'\w*impact\b', re.I)
+AUTHOR_RE = re.compile(r'^Author:[ \t]*(?P<name>.*?)[ \t]*'
+                       r'<(?P<email>[^>]*)>', re.M)
+CHANGE_ID_RE = re.compile(r'^[\t ]*Change-Id:[\t ]*(?P<change_id>I[0-9a-f]+)',
+                          re.M)
+
+
+class CommitMessage(object):
+    """Structured view of one or more commits from git log output.
+
+    :ivar bugs: list of (prefix, bug_number) tuples in order of
+        appearance, prefix being None when no prefix was given.
+    :ivar blueprints: set of referenced blueprint names.
+    :ivar impacts: set of lower cased impact flags, e.g. 'docimpact'.
+    :ivar authors: list of (name, email) tuples from the Author: lines.
+    :ivar change_ids: list of Change-Id footers.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.bugs = [(m.group('prefix'), m.group('bug_number'))
+                     for m in BUG_RE.finditer(text)]
+        self.blueprints = set(m.group(2) for m in SPEC_RE.finditer(text))
+        self.impacts = set(m.group(0).lower()
+                           for m in IMPACT_RE.finditer(text))
+        self.authors = [(m.group('name'), m.group('email'))
+                        for m in AUTHOR_RE.finditer(text)]
+        self.change_ids = [m.group('change_id')
+                           for m in CHANGE_ID_RE.finditer(text)]
+
+    @property
+    def change_id(self):
+        """The Change-Id of the most recent commit, if any."""
+        if self.change_ids:
+            return self.change_ids[0]
+        return None
+
+    def has_impact(self, impact):
+        """Is the given impact flag (e.g. 'DocImpact') set."""
+        return impact.lower() in self.impacts
+
+
+def parse(text):
+    return CommitMessage(text)
@@ -0,0 +1,114 @@
+# Copyright (c) 2016 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Shared SSH connections to Gerrit.
+
+Every command runs on its own channel of one SSH connection per
+(host, port, user, key), so the handshake is paid once per process no
+matter how many commands are run. Channels can be opened from several
+threads at once. A connection which has dropped is reopened on next use.
+"""
+
+import logging
+import threading
+
+import paramiko
+
+KEEPALIVE_INTERVAL = 30
+
+log = logging.getLogger("jeepyb.gerrit_ssh")
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+class GerritSSH(object):
+    def __init__(self, host='localhost', username=None, key_filename=None,
+                 port=29418, keepalive=KEEPALIVE_INTERVAL):
+        self.host = host
+        self.username = username
+        self.key_filename = key_filename
+        self.port = int(port)
+        self.keepalive = keepalive
+        self.client = None
+        self.lock = threading.Lock()
+
+    def _connected(self):
+        if self.client is None:
+            return False
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def connect(self):
+        with self.lock:
+            if self._connected():
+                return self.client
+            if self.client is not None:
+                log.info("Reconnecting to %s:%s", self.host, self.port)
+                self.client.close()
+            client = paramiko.SSHClient()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            client.connect(self.host, username=self.username,
+                           key_filename=self.key_filename, port=self.port)
+            if self.keepalive:
+                client.get_transport().set_keepalive(self.keepalive)
+            self.client = client
+            return client
+
+    def exec_command(self, command):
+        """Start command on a new channel, returns (stdin, stdout, stderr).
+
+        If the connection turns out to be dead the command is retried
+        once on a new connection.
+        """
+        try:
+            return self.connect().exec_command(command)
+        except (paramiko.SSHException, EOFError, IOError):
+            log.debug("Channel open failed, reconnecting", exc_info=True)
+            with self.lock:
+                if self.client is not None:
+                    self.client.close()
+                self.client = None
+            return self.connect().exec_command(command)
+
+    def run(self, command):
+        """Run command and wait for it, returns (status, stdout, stderr)."""
+        stdin, stdout, stderr = self.exec_command(command)
+        out = stdout.read()
+        err = stderr.read()
+        status = stdout.channel.recv_exit_status()
+        return status, out, err
+
+    def close(self):
+        with self.lock:
+            if self.client is not None:
+                self.client.close()
+                self.client = None
+
+
+def get_connection(host='localhost', username=None, key_filename=None,
+                   port=29418):
+    """Return the shared connection for these parameters."""
+    key = (host, int(port), username, key_filename)
+    with _connections_lock:
+        if key not in _connections:
+            _connections[key] = GerritSSH(host, username, key_filename, port)
+        return _connections[key]
+
+
+def close_all():
+    with _connections_lock:
+        for conn in _connections.values():
+            conn.close()
+        _connections.clear()
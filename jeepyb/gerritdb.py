@@ -15,8 +15,15 @@
 # under the License.
 
 import ConfigParser
+import contextlib
+import logging
 import os
 import StringIO
+import sys
+import threading
+import time
+
+import six
 
 
 GERRIT_CONFIG = os.environ.get(
@@ -25,46 +32,308 @@ GERRIT_CONFIG = os.environ.get(
 GERRIT_SECURE_CONFIG = os.environ.get(
     'GERRIT_SECURE_CONFIG',
     '/home/gerrit2/review_site/etc/secure.config')
+POOL_SIZE = int(os.environ.get('GERRIT_DB_POOL_SIZE', '4'))
+# Connections idle for longer than this are checked before being reused
+HEALTH_CHECK_INTERVAL = 60
+
+log = logging.getLogger("jeepyb.gerritdb")
+
 db_connection = None
+_last_used = None
+_pool = None
+_pool_lock = threading.Lock()
+# filename -> (mtime, parsed config)
+_configs = {}
 
 
 def get_broken_config(filename):
     """gerrit config ini files are broken and have leading tabs."""
-    text = ""
-    for line in open(filename, "r"):
-        text += line.lstrip()
+    mtime = os.stat(filename).st_mtime
+    cached = _configs.get(filename)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    with open(filename, "r") as conf:
+        text = "".join(line.lstrip() for line in conf)
 
     fp = StringIO.StringIO(text)
     c = ConfigParser.ConfigParser()
     c.readfp(fp)
+    _configs[filename] = (mtime, c)
     return c
 
 
+def _new_connection():
+    gerrit_config = get_broken_config(GERRIT_CONFIG)
+    secure_config = get_broken_config(GERRIT_SECURE_CONFIG)
+
+    DB_TYPE = gerrit_config.get("database", "type")
+    DB_HOST = gerrit_config.get("database", "hostname")
+    DB_USER = gerrit_config.get("database", "username")
+    DB_PASS = secure_config.get("database", "password")
+    DB_DB = gerrit_config.get("database", "database")
+
+    if DB_TYPE.upper() == "MYSQL":
+        import pymysql
+        return pymysql.connect(
+            host=DB_HOST, user=DB_USER, password=DB_PASS, db=DB_DB)
+    else:
+        import psycopg2
+        return psycopg2.connect(
+            host=DB_HOST, user=DB_USER, password=DB_PASS, database=DB_DB)
+
+
+def _is_healthy(conn):
+    # Not every driver has ping(), but they can all run a query
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1")
+        cursor.fetchall()
+        cursor.close()
+        conn.rollback()
+        return True
+    except Exception:
+        log.info("Discarding unresponsive database connection")
+        return False
+
+
+def _close(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+class ConnectionPool(object):
+    """A thread safe pool of database connections.
+
+    At most size connections are open at once, acquire() blocks when
+    they are all in use. Connections are only checked for liveness when
+    they have been idle for longer than check_interval seconds.
+    """
+
+    def __init__(self, size=POOL_SIZE, connect=_new_connection,
+                 check_interval=HEALTH_CHECK_INTERVAL):
+        self.size = size
+        self.connect = connect
+        self.check_interval = check_interval
+        self.idle = []
+        self.open = 0
+        self.cond = threading.Condition()
+
+    def check(self, conn, last_used):
+        """Return conn, or a new connection if conn has gone bad."""
+        if time.time() - last_used < self.check_interval:
+            return conn
+        if _is_healthy(conn):
+            return conn
+        _close(conn)
+        return self.connect()
+
+    def acquire(self):
+        with self.cond:
+            while not self.idle and self.open >= self.size:
+                self.cond.wait()
+            if self.idle:
+                conn, last_used = self.idle.pop()
+            else:
+                conn, last_used = None, None
+                self.open += 1
+        try:
+            if conn is None:
+                return self.connect()
+            return self.check(conn, last_used)
+        except Exception:
+            self.discard()
+            raise
+
+    def release(self, conn):
+        with self.cond:
+            self.idle.append((conn, time.time()))
+            self.cond.notify()
+
+    def discard(self, conn=None):
+        """Give up a connection which is broken or was never opened."""
+        if conn is not None:
+            _close(conn)
+        with self.cond:
+            self.open -= 1
+            self.cond.notify()
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        except Exception:
+            exc_info = sys.exc_info()
+            try:
+                conn.rollback()
+            except Exception:
+                self.discard(conn)
+            else:
+                self.release(conn)
+            six.reraise(*exc_info)
+        self.release(conn)
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool()
+        return _pool
+
+
+@contextlib.contextmanager
+def cursor():
+    """Context manager for a cursor on a pooled connection.
+
+    The transaction is committed when the block exits normally, rolled
+    back otherwise, and the connection is returned to the pool.
+    """
+    with get_pool().connection() as conn:
+        cur = conn.cursor()
+        try:
+            yield cur
+        finally:
+            cur.close()
+        conn.commit()
+
+
 def connect():
-    global db_connection
+    """Return the connection for this process.
+
+    Kept for single threaded callers that manage their own cursors, it
+    is not part of the pool. Threads should use cursor() instead.
+    """
+    global db_connection, _last_used
     if not db_connection:
-        gerrit_config = get_broken_config(GERRIT_CONFIG)
-        secure_config = get_broken_config(GERRIT_SECURE_CONFIG)
-
-        DB_TYPE = gerrit_config.get("database", "type")
-        DB_HOST = gerrit_config.get("database", "hostname")
-        DB_USER = gerrit_config.get("database", "username")
-        DB_PASS = secure_config.get("database", "password")
-        DB_DB = gerrit_config.get("database", "database")
-
-        if DB_TYPE.upper() == "MYSQL":
-            import pymysql
-            db_connection = pymysql.connect(
-                host=DB_HOST, user=DB_USER, password=DB_PASS, db=DB_DB)
-        else:
-            import psycopg2
-            db_connection = psycopg2.connect(
-                host=DB_HOST, user=DB_USER, password=DB_PASS, database=DB_DB)
+        db_connection = _new_connection()
     else:
-        try:
-            # Make sure the database is responding and reconnect if not
-            db_connection.ping(True)
-        except AttributeError:
-            # This database driver lacks a ping implementation
-            pass
+        db_connection = get_pool().check(db_connection, _last_used)
+    _last_used = time.time()
     return db_connection
+
+
+# The counterintuitive openid_by_email query is due to odd database
+# schema choices in Gerrit. For example, an account with a secondary
+# E-mail address added looks like...
+# select email_address,external_id from account_external_ids
+#     where account_id=1234;
+# +-----------------+-----------------------------------------+
+# | email_address   | external_id                             |
+# +-----------------+-----------------------------------------+
+# | plugh@xyzzy.com | https://login.ubuntu.com/+id/fR0bnU1 |
+# | bar@foo.org     | mailto:bar@foo.org                      |
+# | NULL            | username:quux                           |
+# +-----------------+-----------------------------------------+
+# ...thus we need a join on a secondary query to search against
+# all the user's configured E-mail addresses.
+#
+# Worse, we also need to filter by active accounts only since
+# picking an inactive account could result in using the wrong
+# OpenId entirely.
+QUERIES = {
+    'openid_by_email': """
+        SELECT t.external_id FROM account_external_ids t
+        INNER JOIN (
+            SELECT t.account_id FROM account_external_ids t
+            WHERE t.email_address = %s )
+        original ON t.account_id = original.account_id
+        AND t.external_id LIKE 'https://login.ubuntu.com%%'
+        JOIN accounts a ON a.account_id = t.account_id
+        WHERE a.inactive = 'N'""",
+    'change_by_key': """
+        SELECT subject, topic FROM changes WHERE change_key = %s""",
+    'group_uuid': """
+        SELECT group_uuid FROM account_groups WHERE name = %s""",
+    # Stops at the second patch set, enough to spot a first-timer
+    'patch_sets_by_email': """
+        SELECT DISTINCT p.change_id, p.patch_set_id
+        FROM patch_sets p, account_external_ids a
+        WHERE a.email_address = %s
+        AND a.account_id = p.uploader_account_id
+        LIMIT 2""",
+    # The outer join returns the patch set even without approvals
+    'patch_set_approvals': """
+        SELECT p.revision, a.value, a.account_id, a.category_id
+        FROM changes c
+        JOIN patch_sets p ON p.change_id = c.change_id
+        LEFT JOIN patch_set_approvals a
+        ON a.change_id = p.change_id
+        AND a.patch_set_id = p.patch_set_id
+        AND a.value <> 0
+        WHERE c.change_key = %s AND p.patch_set_id = %s""",
+}
+CACHE_TTL = 600
+
+# (query name, params) -> (expiry, rows)
+_query_cache = {}
+_query_cache_lock = threading.Lock()
+
+
+def query(name, params, cache=False):
+    """Run a named query, returning all its rows.
+
+    With cache set, non-empty results are remembered for CACHE_TTL
+    seconds. Only use it for lookups which rarely change.
+    """
+    key = (name, params)
+    if cache:
+        with _query_cache_lock:
+            cached = _query_cache.get(key)
+        if cached and cached[0] > time.time():
+            return cached[1]
+
+    with cursor() as cur:
+        cur.execute(QUERIES[name], params)
+        rows = cur.fetchall()
+
+    if cache and rows:
+        with _query_cache_lock:
+            _query_cache[key] = (time.time() + CACHE_TTL, rows)
+    return rows
+
+
+def clear_cache():
+    with _query_cache_lock:
+        _query_cache.clear()
+
+
+def get_openid(email):
+    """Return the Launchpad OpenID of the active account with email."""
+    rows = query('openid_by_email', (email,), cache=True)
+    if rows:
+        return rows[0][0]
+    return None
+
+
+def get_change(change_key):
+    """Return (subject, topic) of a change, or None."""
+    rows = query('change_by_key', (change_key,))
+    if rows:
+        return rows[0]
+    return None
+
+
+def get_group_uuid(group):
+    """Return the UUID of an internal group, or None."""
+    rows = query('group_uuid', (group,), cache=True)
+    if rows:
+        return rows[0][0]
+    return None
+
+
+def get_patch_sets_by_email(email):
+    """Return up to two patch sets uploaded by the account with email."""
+    return query('patch_sets_by_email', (email,))
+
+
+def get_patch_set_approvals(change_key, patch_set_id):
+    """Return (revision, value, account_id, category_id) rows.
+
+    There is one row per non-zero approval, or a single row with only
+    the revision set if the patch set has no approvals.
+    """
+    return query('patch_set_approvals', (change_key, patch_set_id))
@@ -0,0 +1,114 @@
+# Copyright (c) 2016 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Read the git log of a merged change for the gerrit hooks.
+
+Several hooks fire for the same event and all of them need the same log,
+so it is cached on disk keyed by commit sha. The cache is a directory
+with one file per commit, kept to CACHE_SIZE entries by evicting the
+least recently used ones.
+"""
+
+import logging
+import os
+import re
+import subprocess
+import tempfile
+
+BASE_DIR = '/home/gerrit2/review_site'
+# Merges of long lived branches can bring in thousands of commits, only
+# look at the most recent ones.
+MAX_COMMITS = 50
+CACHE_SIZE = 256
+
+SHA_RE = re.compile(r'^[0-9a-f]{40}$')
+
+log = logging.getLogger("jeepyb.gitlog")
+
+
+def _cache_file(cache_dir, commit, max_commits):
+    if not cache_dir or not SHA_RE.match(commit):
+        # Only full shas are immutable enough to cache
+        return None
+    return os.path.join(cache_dir, '%s-%d' % (commit, max_commits))
+
+
+def _read_cache(path):
+    try:
+        with open(path, 'r') as cache_file:
+            git_log = cache_file.read()
+        # Mark as recently used
+        os.utime(path, None)
+        return git_log
+    except (IOError, OSError):
+        return None
+
+
+def _write_cache(cache_dir, path, git_log):
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        (fd, tmp_path) = tempfile.mkstemp(dir=cache_dir, prefix='.tmp')
+        with os.fdopen(fd, 'w') as cache_file:
+            cache_file.write(git_log)
+        os.rename(tmp_path, path)
+        _prune_cache(cache_dir)
+    except (IOError, OSError):
+        log.debug("Unable to cache git log in %s" % cache_dir, exc_info=True)
+
+
+def _prune_cache(cache_dir):
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.startswith('.tmp'):
+            continue
+        path = os.path.join(cache_dir, name)
+        try:
+            entries.append((os.stat(path).st_mtime, path))
+        except OSError:
+            # Removed by a concurrent prune
+            pass
+    if len(entries) <= CACHE_SIZE:
+        return
+    entries.sort()
+    for mtime, path in entries[:len(entries) - CACHE_SIZE]:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+def extract_git_log(project, commit, cache_dir=None, base_dir=BASE_DIR,
+                    max_commits=MAX_COMMITS):
+    """Extract git log of all merged commits.
+
+    For a merge commit this is the log of the branch that was merged,
+    limited to its max_commits most recent commits.
+    """
+    path = _cache_file(cache_dir, commit, max_commits)
+    if path:
+        git_log = _read_cache(path)
+        if git_log is not None:
+            return git_log
+
+    cmd = ['git',
+           '--git-dir=' + base_dir + '/git/' + project + '.git',
+           'log', '--no-merges', '--max-count=%d' % max_commits,
+           commit + '^1..' + commit]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    git_log = proc.communicate()[0]
+
+    if path and proc.returncode == 0:
+        _write_cache(cache_dir, path, git_log)
+    return git_log
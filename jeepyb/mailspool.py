@@ -0,0 +1,229 @@
+# Copyright (c) 2016 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""SMTP helpers and a local mail spool.
+
+Hooks which send mail can enqueue messages in a spool directory instead
+of opening an SMTP session per event. The spool is later flushed over a
+single SMTP session, optionally combining the messages for each
+destination into one digest per time window.
+
+The spool uses the maildir layout: messages are written to tmp/ and
+renamed into new/, so a flush never sees a partially written message.
+"""
+
+import json
+import logging
+import os
+import smtplib
+import time
+import uuid
+
+from email.mime import text
+
+import six
+
+
+log = logging.getLogger("jeepyb.mailspool")
+
+FIELDS = ('time', 'sender', 'to', 'subject', 'body')
+
+
+def setup_smtp_arguments(parser):
+    """Sets up the SMTP connection arguments on the given parser."""
+    parser.add_argument('--smtp-from', dest='smtp_from',
+                        default='gerrit2@review.openstack.org')
+
+    parser.add_argument('--smtp-host', dest='smtp_host', default="localhost")
+    parser.add_argument('--smtp-port', dest='smtp_port')
+
+    parser.add_argument('--smtp-ssl', dest='smtp_ssl', action='store_true')
+    parser.add_argument('--smtp-starttls', dest='smtp_starttls',
+                        action='store_true')
+
+    parser.add_argument('--smtp-user', dest='smtp_user',
+                        default=os.getenv('SMTP_USER'))
+    parser.add_argument('--smtp-pass', dest='smtp_pass',
+                        default=os.getenv('SMTP_PASS'))
+
+
+def smtp_connection(args):
+    """Create SMTP connection based on command line arguments, falling
+    back to sensible defaults if no arguments are provided.
+    """
+    conn = None
+    if args.smtp_ssl:
+        port = 465 if not args.smtp_port else args.smtp_port
+        conn = smtplib.SMTP_SSL(args.smtp_host, port)
+    else:
+        port = 25 if not args.smtp_port else args.smtp_port
+        conn = smtplib.SMTP(args.smtp_host, port)
+
+    if args.smtp_starttls:
+        conn.starttls()
+        conn.ehlo()
+
+    if args.smtp_user and args.smtp_pass:
+        conn.login(args.smtp_user, args.smtp_pass)
+
+    return conn
+
+
+def _text(value):
+    """Return value as text, replacing bytes which are not UTF-8."""
+    if isinstance(value, six.binary_type):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def make_message(sender, to, subject, body):
+    msg = text.MIMEText(_text(body).encode('utf-8'), 'plain', 'utf-8')
+    msg['Subject'] = subject
+    msg['From'] = sender
+    msg['To'] = to
+    return msg
+
+
+class MailSpool(object):
+    """A directory of messages waiting to be sent."""
+
+    def __init__(self, spool_dir):
+        self.spool_dir = spool_dir
+        self.tmp_dir = os.path.join(spool_dir, 'tmp')
+        self.new_dir = os.path.join(spool_dir, 'new')
+
+    def _ensure_dirs(self):
+        for path in (self.tmp_dir, self.new_dir):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+    def enqueue(self, sender, to, subject, body):
+        """Queue a message, returning the name of its spool file."""
+        self._ensure_dirs()
+        now = time.time()
+        name = '%017.6f.%d.%s' % (now, os.getpid(), uuid.uuid4().hex)
+        tmp_path = os.path.join(self.tmp_dir, name)
+        with open(tmp_path, 'w') as spool_file:
+            # e.g. git logs are not necessarily UTF-8, which JSON needs
+            json.dump(dict(time=now, sender=sender, to=to,
+                           subject=_text(subject), body=_text(body)),
+                      spool_file)
+        os.rename(tmp_path, os.path.join(self.new_dir, name))
+        return name
+
+    def pending(self):
+        """Return the queued messages as (path, message) in queue order."""
+        if not os.path.isdir(self.new_dir):
+            return []
+        messages = []
+        for name in sorted(os.listdir(self.new_dir)):
+            path = os.path.join(self.new_dir, name)
+            try:
+                with open(path, 'r') as spool_file:
+                    msg = json.load(spool_file)
+            except (IOError, ValueError):
+                log.exception("Skipping unreadable spool file %s" % path)
+                continue
+            if not isinstance(msg, dict) or not all(key in msg
+                                                    for key in FIELDS):
+                log.error("Skipping incomplete spool file %s" % path)
+                continue
+            messages.append((path, msg))
+        return messages
+
+    def _batches(self, digest_window, now):
+        """Group pending messages into the mails to send.
+
+        Without a digest window every message is sent on its own.
+        Otherwise messages are grouped per sender, destination and
+        window, and a group is only sent once its window has closed.
+        """
+        pending = self.pending()
+        if not digest_window:
+            return [[entry] for entry in pending]
+
+        groups = {}
+        for path, msg in pending:
+            window = int(msg['time'] // digest_window)
+            key = (msg['sender'], msg['to'], window)
+            groups.setdefault(key, []).append((path, msg))
+        batches = []
+        for (sender, to, window), batch in sorted(groups.items()):
+            if (window + 1) * digest_window > now:
+                continue
+            batches.append(batch)
+        return batches
+
+    def _digest(self, batch):
+        if len(batch) == 1:
+            msg = batch[0][1]
+            return msg['subject'], msg['body']
+        subjects = [msg['subject'] for path, msg in batch]
+        subject = '[digest] %d review requests' % len(batch)
+        body = '\n'.join(
+            ['This digest contains:', ''] +
+            ['  %s' % s for s in subjects] +
+            ['\n%s\n%s' % ('-' * 72, msg['body']) for path, msg in batch])
+        return subject, body
+
+    def flush(self, connect, digest_window=None, now=None):
+        """Send the pending messages over one SMTP connection.
+
+        :param connect: callable returning a connected smtplib.SMTP.
+        :param digest_window: if set, combine the messages for each
+            destination into one digest per window of this many seconds.
+        :returns: the number of spooled messages which were sent.
+        """
+        if now is None:
+            now = time.time()
+        batches = self._batches(digest_window, now)
+        conn = None
+        sent = 0
+        try:
+            for batch in batches:
+                try:
+                    sender = batch[0][1]['sender']
+                    to = batch[0][1]['to']
+                    subject, body = self._digest(batch)
+                    mail = make_message(sender, to, subject,
+                                        body).as_string()
+                except Exception:
+                    # A malformed message must not hold up the rest
+                    log.exception("Failed to build mail from %s" %
+                                  ', '.join(path for path, msg in batch))
+                    continue
+                if conn is None:
+                    conn = connect()
+                try:
+                    try:
+                        conn.sendmail(sender, to, mail)
+                    except smtplib.SMTPServerDisconnected:
+                        # Reconnect once, e.g. after the server timed us out
+                        conn = connect()
+                        conn.sendmail(sender, to, mail)
+                except smtplib.SMTPException:
+                    # Including failures of the retry, the rest of the
+                    # spool is still sent
+                    log.exception("Failed to send mail to %s" % to)
+                    continue
+                for path, msg in batch:
+                    os.unlink(path)
+                sent += len(batch)
+        finally:
+            if conn is not None:
+                try:
+                    conn.quit()
+                except smtplib.SMTPException:
+                    pass
+        return sent
@@ -27,6 +27,7 @@ Expected review.projects.yaml format:
 """
 
 import ConfigParser
+import os
 
 import jeepyb.utils as u
 
@@ -92,3 +93,9 @@ def is_delay_release(project_full_name):
 def docimpact_target(project_full_name):
     return registry.get_project_item(project_full_name, 'docimpact-group',
                                      'unknown')
+
+
+def cache_path(*parts):
+    """Return a path inside the jeepyb-cache-dir."""
+    return os.path.join(
+        registry.get_defaults('jeepyb-cache-dir', '/var/lib/jeepyb'), *parts)
@@ -0,0 +1,105 @@
+# Copyright (c) 2016 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from jeepyb.cmd import trivial_rebase
+
+
+class TestPatchIds(unittest.TestCase):
+    """Compares _PatchIds with git patch-id on a scratch repo."""
+
+    def setUp(self):
+        self.repo = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.repo)
+        cwd = os.getcwd()
+        os.chdir(self.repo)
+        self.addCleanup(os.chdir, cwd)
+        self.env = dict(os.environ,
+                        GIT_AUTHOR_NAME='Test', GIT_AUTHOR_EMAIL='t@example',
+                        GIT_COMMITTER_NAME='Test',
+                        GIT_COMMITTER_EMAIL='t@example')
+        self._git('init', '-q')
+        self._commit({'f1': 'a\nb\nc\n', 'f2': 'x\n', 'f3': 'keep\n'})
+        self.base = self._git('rev-parse', 'HEAD').strip()
+
+    def _git(self, *args, **kwargs):
+        return subprocess.check_output(('git',) + args, env=self.env,
+                                       **kwargs)
+
+    def _commit(self, files):
+        for name, content in files.items():
+            with open(os.path.join(self.repo, name), 'w') as f:
+                f.write(content)
+        self._git('add', '-A')
+        self._git('commit', '-q', '-m', 'change')
+        return self._git('rev-parse', 'HEAD').strip()
+
+    def _git_patch_id(self, revision):
+        show = subprocess.Popen(['git', 'show', revision],
+                                stdout=subprocess.PIPE, env=self.env)
+        out = self._git('patch-id', stdin=show.stdout)
+        show.wait()
+        return out.split()[0] if out else None
+
+    def _patch_id(self, revision):
+        diffs = trivial_rebase.CommitReader().Read([revision])
+        return trivial_rebase._PatchIds(diffs[revision])[0]
+
+    def _check(self, files):
+        self._git('checkout', '-q', self.base)
+        revision = self._commit(files)
+        self.assertEqual(self._git_patch_id(revision),
+                         self._patch_id(revision))
+        return revision
+
+    def test_multiple_files(self):
+        self._check({'f1': 'a\nB\nc\n', 'f2': 'y\n', 'f3': 'keep\nmore\n'})
+
+    def test_no_newline_at_end_of_file(self):
+        first = self._check({'f1': 'a\nb\nc', 'f2': 'Y\n'})
+        second = self._check({'f1': 'a\nb\nc', 'f2': 'ZZZ\n'})
+        self.assertNotEqual(self._patch_id(first), self._patch_id(second))
+
+    def test_no_newline_in_middle_file(self):
+        self._check({'f1': 'a\nb', 'f2': 'x', 'f3': 'changed\n'})
+
+    def test_carriage_return_in_line(self):
+        first = self._check({'f1': 'a\nt\r wo\nc\n', 'f2': '2\n'})
+        second = self._check({'f1': 'a\nt\r wo\nc\n', 'f2': '3\n'})
+        self.assertNotEqual(self._patch_id(first), self._patch_id(second))
+
+    def test_form_feed(self):
+        first = self._check({'f1': 'a\nx\fy\n\f\n', 'f2': '2\n'})
+        second = self._check({'f1': 'a\nxy\n\n', 'f2': '2\n'})
+        self.assertNotEqual(self._patch_id(first), self._patch_id(second))
+
+    def test_carriage_return_whitespace(self):
+        first = self._check({'f1': 'a\nt wo\r\nc\n', 'f2': '2\n'})
+        second = self._check({'f1': 'a\ntwo\nc\n', 'f2': '2\n'})
+        self.assertEqual(self._patch_id(first), self._patch_id(second))
+
+    def test_empty_diff(self):
+        self._git('checkout', '-q', self.base)
+        self._git('commit', '-q', '--allow-empty', '-m', 'empty')
+        revision = self._git('rev-parse', 'HEAD').strip()
+        self.assertIsNone(self._patch_id(revision))
+
+
+if __name__ == '__main__':
+    unittest.main()
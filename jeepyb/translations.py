@@ -20,10 +20,16 @@ except ImportError:
     from urlparse import urljoin
 
 import requests
+from requests import adapters
+from requests.packages.urllib3.util import retry
+
+# (connect, read) timeouts in seconds
+TIMEOUT = (10, 60)
+RETRIES = 3
 
 
 class ZanataRestService:
-    def __init__(self, url, username, api_key, verify=False):
+    def __init__(self, url, username, api_key, verify=False, pool_size=10):
         self.url = url
         self.verify = verify
         content_type = 'application/json;charset=utf8'
@@ -31,6 +37,17 @@ class ZanataRestService:
                         'Content-Type': content_type,
                         'X-Auth-User': username,
                         'X-Auth-Token': api_key}
+        # One session keeps connections alive across requests and threads
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        self.session.verify = verify
+        retries = retry.Retry(total=RETRIES, backoff_factor=0.5,
+                              status_forcelist=(500, 502, 503, 504))
+        adapter = adapters.HTTPAdapter(pool_connections=1,
+                                       pool_maxsize=pool_size,
+                                       max_retries=retries)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
 
     def _construct_url(self, url_fragment):
         return urljoin(self.url, url_fragment)
@@ -38,19 +55,27 @@ class ZanataRestService:
     def query(self, url_fragment):
         request_url = self._construct_url(url_fragment)
         try:
-            return requests.get(request_url, verify=self.verify,
-                                headers=self.headers)
-        except requests.exceptions.ConnectionError:
+            return self.session.get(request_url, timeout=TIMEOUT)
+        except requests.exceptions.RequestException:
+            # Includes timeouts and running out of retries
             raise ValueError('Connection error')
 
     def push(self, url_fragment, data):
         request_url = self._construct_url(url_fragment)
         try:
-            return requests.put(request_url, verify=self.verify,
-                                headers=self.headers, data=json.dumps(data))
-        except requests.exceptions.ConnectionError:
+            return self.session.put(request_url, data=json.dumps(data),
+                                    timeout=TIMEOUT)
+        except requests.exceptions.RequestException:
+            # Includes timeouts and running out of retries
             raise ValueError('Connection error')
 
+    def list_projects(self):
+        """Return the set of the ids of all projects."""
+        r = self.query('/rest/projects')
+        if r.status_code != 200:
+            raise ValueError('Failed to list projects.')
+        return set(project['id'] for project in r.json())
+
 
 class TranslationProject:
     def __init__(self, rest_service, project):
@@ -82,10 +107,23 @@ class TranslationProject:
             iteration)
         return r.status_code in (200, 201)
 
-    def register(self):
-        if not self.is_registered():
+    def register(self, known_projects=None):
+        """Register the project and its master iteration if needed.
+
+        known_projects is the set of ids of the existing projects, if it
+        is given the project is not probed for.
+        """
+        if known_projects is not None:
+            registered = self.project in known_projects
+        else:
+            registered = self.is_registered()
+        if not registered:
             if not self.register_project():
                 raise ValueError('Failed to register project.')
-        if not self.has_master():
+            # A new project has no iterations yet
+            has_master = False
+        else:
+            has_master = self.has_master()
+        if not has_master:
             if not self.register_master_iteration():
                 raise ValueError('Failed to register master iteration.')
@@ -13,9 +13,11 @@
 # under the License.
 
 import ConfigParser
+import hashlib
 import logging
 import os
 import shlex
+import stat
 import subprocess
 import tempfile
 import yaml
@@ -166,6 +168,42 @@ project=%s
         return "push %s HEAD:refs/heads/master"
 
 
+def _file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_if_changed(path, content):
+    """Replace the file at path with content, unless it already has it.
+
+    The new content is written to a temporary file which is renamed over
+    path, so readers never see a partial file. The mode of an existing
+    file is kept. Returns True if the file was written.
+    """
+    mode = 0o644
+    try:
+        if _file_digest(path) == hashlib.sha1(content).hexdigest():
+            return False
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    except (IOError, OSError):
+        pass
+    (fd, tmp_path) = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)),
+        prefix='.%s.' % os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.chmod(tmp_path, mode)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+    return True
+
+
 def fsck_repo(repo_path):
     rc, out = git_command_output(repo_path, 'fsck --full')
     # Check for non zero return code or warnings which should
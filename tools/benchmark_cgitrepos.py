@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# Copyright (c) 2016 OpenStack Foundation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# Time the generation of the cgitrepos files from synthetic projects,
+# without touching any repos:
+#
+#     python tools/benchmark_cgitrepos.py --projects 10000
+
+from __future__ import print_function
+
+import argparse
+import random
+import timeit
+
+from jeepyb.cmd import create_cgitrepos
+
+
+def synthetic_projects(count, orgs, seed=0):
+    rand = random.Random(seed)
+    projects = []
+    for i in range(count):
+        entry = {'project': 'org%d/project-%d' % (rand.randrange(orgs), i),
+                 'description': 'Synthetic project %d\nfor benchmarks' % i}
+        if i % 10 == 0:
+            entry['cgit-alias'] = {'site': 'site%d.example.org' % (i % 3),
+                                   'path': 'project-%d' % i}
+        projects.append(entry)
+    rand.shuffle(projects)
+    return projects
+
+
+def generate(projects):
+    records = create_cgitrepos.project_records(projects)
+    content = ''.join(create_cgitrepos.render_cgitrepos(records))
+    alias_sites = {}
+    for (org, name, project, description, alias) in records:
+        if alias:
+            alias_sites.setdefault(alias[0], []).append(
+                (alias[1], project, description))
+    for aliases in alias_sites.values():
+        content += ''.join(create_cgitrepos.render_alias_site(aliases))
+    return content
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark cgitrepos generation')
+    parser.add_argument('--projects', type=int, default=10000)
+    parser.add_argument('--orgs', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    projects = synthetic_projects(args.projects, args.orgs)
+    timer = timeit.Timer(lambda: generate(projects))
+    best = min(timer.repeat(repeat=args.repeat, number=1))
+    print('%d projects in %d orgs: best of %d runs %.3fs (%d bytes)'
+          % (args.projects, args.orgs, args.repeat, best,
+             len(generate(projects))))
+
+
+if __name__ == '__main__':
+    main()